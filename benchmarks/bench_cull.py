@@ -0,0 +1,141 @@
+'''
+Culling benchmark
+=================
+
+Compare the cost of finding the objects overlapping the viewport with a
+linear scan (what MainPlane.cull_children used to do), with the QuadTree
+index, and with the NumPy CircleArray when NumPy is available, for an
+increasing number of objects.
+
+The QuadTree queries are first checked against the linear scan on random
+boxes, including boxes outside of the bounds of the tree.
+
+Usage::
+
+    python benchmarks/bench_cull.py [count ...]
+'''
+
+import sys
+from os.path import join, dirname
+from random import Random
+from time import time
+
+sys.path.insert(0, join(dirname(__file__), '..', 'presemt'))
+from quadtree import QuadTree, bbox_overlap
+from circles import CircleArray
+
+COUNTS = (100, 1000, 5000, 10000, 50000)
+WORLD = 20000.
+VIEWPORT = (-512., -384., 512., 384.)
+ROUNDS = 50
+
+
+def generate(count, seed=0):
+    rnd = Random(seed)
+    boxes = []
+    for i in xrange(count):
+        x = rnd.uniform(-WORLD, WORLD)
+        y = rnd.uniform(-WORLD, WORLD)
+        w = rnd.uniform(20, 600)
+        h = rnd.uniform(20, 400)
+        boxes.append((x, y, x + w, y + h))
+    return boxes
+
+
+def check_index(seed=0, count=2000, rounds=200):
+    # boxes anywhere, up to 4 times the tree bounds, moved while queried
+    rnd = Random(seed)
+    limit = 65536. * 4
+
+    def random_box(size):
+        x = rnd.uniform(-limit, limit)
+        y = rnd.uniform(-limit, limit)
+        return (x, y, x + rnd.uniform(0, size), y + rnd.uniform(0, size))
+
+    tree = QuadTree()
+    boxes = {}
+    for i in xrange(count):
+        # many small boxes near the origin, to split the nodes around far
+        # away boxes kept in the root
+        if rnd.random() < .5:
+            x = rnd.uniform(-1000, 1000)
+            y = rnd.uniform(-1000, 1000)
+            boxes[i] = (x, y, x + 10, y + 10)
+        else:
+            boxes[i] = random_box(100000)
+        tree.insert(i, boxes[i])
+    for r in xrange(rounds):
+        for i in rnd.sample(boxes, 20):
+            boxes[i] = random_box(100000)
+            tree.update(i, boxes[i])
+        query = random_box(limit)
+        expected = sorted(i for i, b in boxes.iteritems()
+                          if bbox_overlap(b, query))
+        assert sorted(tree.query(query)) == expected, (seed, r, query)
+
+
+def bench_linear(boxes):
+    start = time()
+    for i in xrange(ROUNDS):
+        visible = [b for b in boxes if bbox_overlap(b, VIEWPORT)]
+    return (time() - start) / ROUNDS, len(visible)
+
+
+def bench_index(boxes):
+    tree = QuadTree()
+    start = time()
+    for i, b in enumerate(boxes):
+        tree.insert(i, b)
+    build = time() - start
+    start = time()
+    for i in xrange(ROUNDS):
+        visible = tree.query(VIEWPORT)
+    return (time() - start) / ROUNDS, len(visible), build
+
+
+def bench_circles(boxes):
+    circles = CircleArray()
+    for i, (x1, y1, x2, y2) in enumerate(boxes):
+        circles.update(i, (x1 + x2) / 2., (y1 + y2) / 2.,
+                       ((x2 - x1) ** 2 + (y2 - y1) ** 2) ** .5 / 2.)
+    x1, y1, x2, y2 = VIEWPORT
+    radius = ((x2 - x1) ** 2 + (y2 - y1) ** 2) ** .5 / 2.
+    start = time()
+    for i in xrange(ROUNDS):
+        visible = circles.query((x1 + x2) / 2., (y1 + y2) / 2., radius)
+    return (time() - start) / ROUNDS
+
+
+def bench_update(boxes):
+    tree = QuadTree()
+    for i, b in enumerate(boxes):
+        tree.insert(i, b)
+    start = time()
+    for i, b in enumerate(boxes):
+        tree.update(i, (b[0] + 5, b[1] + 5, b[2] + 5, b[3] + 5))
+    return (time() - start) / max(1, len(boxes))
+
+
+def main(counts):
+    for seed in xrange(5):
+        check_index(seed)
+    print '%8s %8s %12s %12s %8s %12s %12s %12s' % (
+        'objects', 'visible', 'linear (ms)', 'index (ms)', 'speedup',
+        'build (ms)', 'update (us)', 'numpy (ms)')
+    for count in counts:
+        boxes = generate(count)
+        t_linear, n_linear = bench_linear(boxes)
+        t_index, n_index, build = bench_index(boxes)
+        assert n_linear == n_index
+        t_update = bench_update(boxes)
+        if CircleArray.available:
+            t_circles = '%12.3f' % (bench_circles(boxes) * 1000)
+        else:
+            t_circles = '%12s' % 'n/a'
+        print '%8d %8d %12.3f %12.3f %7.1fx %12.1f %12.2f %s' % (
+            count, n_index, t_linear * 1000, t_index * 1000,
+            t_linear / max(t_index, 1e-9), build * 1000, t_update * 1e6,
+            t_circles)
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or COUNTS)
@@ -0,0 +1,245 @@
+'''
+Document benchmark suite
+========================
+
+Generate synthetic projects in a temporary workspace, and time:
+
+- Document.save and Document.load
+- Document.encode_thumb and Thumbnail.decode, per thumbnail
+- SelectorScreen.search_documents, with and without the workspace index
+- MainScreen.on_filename, the full rehydration of a project on the plane
+
+The screens need a Kivy window, with the application kv rules loaded. Use
+--no-kivy to only time the document part, or run the suite under xvfb-run
+on a headless machine.
+
+The results are written as json, to keep track of them across releases:
+each benchmark gives the min, median and max time in seconds of its rounds.
+
+Usage::
+
+    python benchmarks/bench_documents.py [--texts 500] [--images 100]
+        [--videos 0] [--slides 20] [--projects 10] [--rounds 5]
+        [--binary] [--no-kivy] [--output results.json]
+'''
+
+import sys
+import json
+import shutil
+import platform
+import tempfile
+from optparse import OptionParser
+from os import makedirs, remove
+from os.path import join, dirname, exists, abspath
+from random import Random
+from time import time
+
+ROOT = abspath(join(dirname(__file__), '..', 'presemt'))
+sys.path.insert(0, ROOT)
+from document import Document, Thumbnail
+
+THUMB_SIZE = (160, 120)
+FONTS = ('DroidSans', 'DroidSans-Bold', 'DroidSerif')
+
+
+def generate_thumb(rnd):
+    # smooth gradient with some noise, closer to a slide than pure noise
+    w, h = THUMB_SIZE
+    base = rnd.randint(0, 128)
+    pixels = []
+    for y in xrange(h):
+        for x in xrange(w):
+            value = (base + x + y + rnd.randint(0, 16)) & 0xff
+            pixels.append(chr(value) * 3)
+    return w, h, ''.join(pixels)
+
+
+def generate_document(options, seed=0):
+    '''Return a Document with the objects and slides asked in the options.
+    Slide thumbnails are raw, they are encoded when the document is saved.
+    '''
+    rnd = Random(seed)
+    doc = Document()
+
+    def common():
+        return {'pos': (rnd.uniform(-5000, 5000), rnd.uniform(-5000, 5000)),
+                'size': (rnd.uniform(20, 600), rnd.uniform(20, 400)),
+                'rotation': rnd.uniform(0, 360),
+                'scale': rnd.uniform(.2, 4)}
+
+    for i in xrange(options.texts):
+        doc.create_text(text='Synthetic text %d' % i, bold=False,
+                        italic=False, color=(1, 1, 1, 1),
+                        font_name=rnd.choice(FONTS), font_size=96,
+                        **common())
+    for i in xrange(options.images):
+        doc.create_image(source=join(ROOT, 'icon.png'), **common())
+    for i in xrange(options.videos):
+        doc.create_video(source='synthetic-%d.avi' % i, **common())
+    thumbs = [None]
+    if options.thumbs:
+        thumbs = [generate_thumb(rnd) for i in xrange(min(options.slides, 4))]
+    for i in xrange(options.slides):
+        doc.add_slide((rnd.uniform(-5000, 5000), rnd.uniform(-5000, 5000)),
+                      rnd.uniform(0, 360), rnd.uniform(.2, 4),
+                      thumbs[i % len(thumbs)])
+    return doc
+
+
+def generate_workspace(workspace, options):
+    '''Create options.projects projects in the workspace, and return their
+    filenames.
+    '''
+    filenames = []
+    for i in xrange(options.projects):
+        directory = join(workspace, 'project_%d' % i)
+        makedirs(directory)
+        filename = join(directory, 'project.json')
+        generate_document(options, seed=i).save(filename,
+                                                 binary=options.binary)
+        filenames.append(filename)
+    return filenames
+
+
+def measure(func, rounds, setup=None):
+    times = []
+    for i in xrange(rounds):
+        arg = setup() if setup else None
+        start = time()
+        func(arg)
+        times.append(time() - start)
+    times.sort()
+    return {'rounds': rounds, 'min': times[0],
+            'median': times[len(times) // 2], 'max': times[-1]}
+
+
+def bench_document(results, options, workspace):
+    filename = join(workspace, 'bench', 'project.json')
+    makedirs(dirname(filename))
+
+    def save(doc):
+        doc.save(filename, binary=options.binary)
+        doc.cleanup()
+    results['save'] = measure(
+        save, options.rounds, lambda: generate_document(options))
+
+    def load(arg):
+        Document().load(filename)
+    results['load'] = measure(load, options.rounds)
+
+    if not options.thumbs:
+        results['encode_thumb'] = results['decode_thumb'] = {
+            'error': 'no jpeg encoder'}
+        return
+    doc = Document()
+    raw = generate_thumb(Random(0))
+    thumb = doc.encode_thumb(raw)
+    count = 10
+    results['encode_thumb'] = measure(
+        lambda arg: [doc.encode_thumb(raw) for i in xrange(count)],
+        options.rounds)
+    results['decode_thumb'] = measure(
+        lambda arg: [Thumbnail(thumb.width, thumb.height,
+                               jpeg=thumb.jpeg).decode()
+                     for i in xrange(count)],
+        options.rounds)
+    for name in ('encode_thumb', 'decode_thumb'):
+        for key in ('min', 'median', 'max'):
+            results[name][key] /= count
+
+
+class BenchApp(object):
+    '''Stand-in for PresemtApp, the screens only need its config.
+    '''
+
+    def __init__(self, workspace):
+        from ConfigParser import RawConfigParser
+        self.config = RawConfigParser()
+        self.config.add_section('paths')
+        self.config.set('paths', 'workspace', workspace)
+
+    def show_start(self):
+        pass
+
+
+def bench_screens(results, options, workspace, filenames):
+    # creating the window gives the GL context needed by the textures
+    from kivy.core.window import Window
+    from kivy.lang import Builder
+    import behaviours
+    import fbocapture
+    Builder.load_file(join(ROOT, 'presemt.kv'))
+    from screens.project import SelectorScreen
+    from screens.presentation import MainScreen
+    app = BenchApp(workspace)
+
+    def search_cold(arg):
+        SelectorScreen(app=app).search_documents()
+
+    def remove_index():
+        index = join(workspace, 'index.json')
+        if exists(index):
+            remove(index)
+    results['search_documents_cold'] = measure(
+        search_cold, options.rounds, remove_index)
+
+    screen = SelectorScreen(app=app)
+    screen.search_documents()
+
+    def search_warm(arg):
+        screen.view.clear_widgets()
+        screen.search_documents()
+    results['search_documents_warm'] = measure(search_warm, options.rounds)
+
+    def rehydrate(screen):
+        screen.filename = filenames[0]
+    results['on_filename'] = measure(
+        rehydrate, options.rounds, lambda: MainScreen(app=app))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--texts', type='int', default=500)
+    parser.add_option('--images', type='int', default=100)
+    parser.add_option('--videos', type='int', default=0)
+    parser.add_option('--slides', type='int', default=20)
+    parser.add_option('--projects', type='int', default=10,
+                      help='number of projects in the workspace')
+    parser.add_option('--rounds', type='int', default=5)
+    parser.add_option('--binary', action='store_true', default=False,
+                      help='save the projects in the binary format')
+    parser.add_option('--no-kivy', dest='kivy', action='store_false',
+                      default=True, help="don't time the screens")
+    parser.add_option('--output', help='write the results in this file')
+    options, args = parser.parse_args()
+    try:
+        Document().encode_thumb((1, 1, '\0\0\0'))
+        options.thumbs = True
+    except ImportError:
+        # neither PIL nor pygame, the slides have no thumbnail
+        options.thumbs = False
+
+    params = dict((key, getattr(options, key)) for key in (
+        'texts', 'images', 'videos', 'slides', 'projects', 'rounds',
+        'binary', 'thumbs'))
+    report = {'version': 1, 'time': time(), 'params': params,
+              'python': platform.python_version(),
+              'platform': platform.platform(), 'results': {}}
+    workspace = tempfile.mkdtemp()
+    try:
+        bench_document(report['results'], options, workspace)
+        if options.kivy:
+            filenames = generate_workspace(workspace, options)
+            bench_screens(report['results'], options, workspace, filenames)
+    finally:
+        shutil.rmtree(workspace)
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as fd:
+            fd.write(data)
+    else:
+        print data
+
+if __name__ == '__main__':
+    main()
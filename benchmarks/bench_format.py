@@ -0,0 +1,82 @@
+'''
+Document format benchmark
+=========================
+
+Compare the json and the binary formats of a Document: time to save, time
+to load and file size, for an increasing number of objects. The documents
+mix text, image and stroke objects, like a real project.
+
+Usage::
+
+    python benchmarks/bench_format.py [count ...]
+'''
+
+import sys
+import shutil
+import tempfile
+from os.path import join, dirname, getsize
+from random import Random
+from time import time
+
+sys.path.insert(0, join(dirname(__file__), '..', 'presemt'))
+from document import Document, encode_points
+
+COUNTS = (100, 1000, 10000, 50000)
+FONTS = ('DroidSans', 'DroidSans-Bold', 'DroidSerif')
+SOURCES = ['data/image%d.png' % x for x in xrange(20)]
+
+
+def generate(count, seed=0):
+    rnd = Random(seed)
+    doc = Document()
+    for i in xrange(count):
+        common = {'pos': (rnd.uniform(-5000, 5000), rnd.uniform(-5000, 5000)),
+                  'size': (rnd.uniform(20, 600), rnd.uniform(20, 400)),
+                  'rotation': rnd.uniform(0, 360), 'scale': rnd.uniform(.2, 4)}
+        kind = rnd.random()
+        if kind < .6:
+            doc.create_text(text='Text %d' % i, bold=False, italic=False,
+                            color=(1, 1, 1, 1), font_name=rnd.choice(FONTS),
+                            font_size=96, **common)
+        elif kind < .9:
+            doc.create_image(source=rnd.choice(SOURCES), **common)
+        else:
+            points = []
+            for j in xrange(rnd.randint(10, 100)):
+                points.extend((rnd.uniform(0, 1000), rnd.uniform(0, 1000)))
+            doc.create_stroke(points=encode_points(points),
+                              color=(1, 1, 1, 1))
+    return doc
+
+
+def bench(doc, filename, binary):
+    start = time()
+    doc.save(filename, binary=binary)
+    save = time() - start
+    doc.cleanup()
+    start = time()
+    loaded = Document()
+    loaded.load(filename)
+    load = time() - start
+    assert loaded.object_count == doc.object_count
+    return save, load, getsize(filename)
+
+
+def main(counts):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print '%8s %7s %10s %10s %12s' % (
+            'objects', 'format', 'save (ms)', 'load (ms)', 'size (KB)')
+        for count in counts:
+            doc = generate(count)
+            for binary in (False, True):
+                save, load, size = bench(
+                    doc, join(tmpdir, 'project.json'), binary)
+                print '%8d %7s %10.1f %10.1f %12.1f' % (
+                    count, binary and 'binary' or 'json', save * 1000,
+                    load * 1000, size / 1024.)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or COUNTS)
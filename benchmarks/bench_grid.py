@@ -0,0 +1,103 @@
+'''
+Grid benchmark
+==============
+
+Compare the frame time of the old background grid, one Line instruction per
+grid line, with the batched Mesh grid of MainPlane, at several zoom levels.
+Needs Kivy and a window.
+
+Usage::
+
+    python benchmarks/bench_grid.py [frames]
+'''
+
+import sys
+from os.path import join, dirname
+from time import time
+
+sys.path.insert(0, join(dirname(__file__), '..', 'presemt'))
+
+from kivy.app import App
+from kivy.clock import Clock
+from kivy.graphics import Color, Line
+from kivy.uix.widget import Widget
+from screens.presentation_plane import MainPlane
+
+FRAMES = 120
+SCALES = (1., 0.2, 4.)
+GRID_SPACING = 50
+GRID_COUNT = 1000
+
+
+class LineGrid(Widget):
+    # the grid as it was drawn before MainPlane.fill_grid used a Mesh
+
+    def __init__(self, **kwargs):
+        super(LineGrid, self).__init__(**kwargs)
+        gs = GRID_SPACING
+        gc = GRID_COUNT * gs
+        with self.canvas:
+            Color(.9, .9, .9, .2)
+            for x in xrange(-gc, gc, gs):
+                Line(points=(x, -gc, x, gc))
+                Line(points=(-gc, x, gc, x))
+
+
+class GridBenchmark(App):
+
+    def build(self):
+        self.frames = int(sys.argv[1]) if len(sys.argv) > 1 else FRAMES
+        self.root = Widget()
+        self.cases = [('lines', None)] + [('mesh', s) for s in SCALES]
+        self.results = []
+        Clock.schedule_once(self.next_case, 1)
+        return self.root
+
+    def next_case(self, *largs):
+        self.root.clear_widgets()
+        if not self.cases:
+            self.report()
+            return
+        self.case = self.cases.pop(0)
+        name, scale = self.case
+        start = time()
+        if name == 'lines':
+            widget = LineGrid()
+            self.root.add_widget(widget)
+        else:
+            widget = MainPlane(grid_spacing=GRID_SPACING,
+                               grid_count=GRID_COUNT)
+            self.root.add_widget(widget)
+            widget.scale = scale
+            widget.fill_grid()
+        self.build_time = time() - start
+        self.times = []
+        self.last = None
+        Clock.schedule_interval(self.tick, 0)
+
+    def tick(self, dt):
+        now = time()
+        if self.last is not None:
+            self.times.append(now - self.last)
+        self.last = now
+        if len(self.times) < self.frames:
+            return
+        name, scale = self.case
+        times = sorted(self.times)
+        self.results.append((name, scale, self.build_time,
+                             sum(times) / len(times),
+                             times[int(len(times) * .95)]))
+        Clock.schedule_once(self.next_case, .5)
+        return False
+
+    def report(self):
+        print '%8s %8s %12s %14s %14s' % (
+            'grid', 'scale', 'build (ms)', 'frame (ms)', 'p95 (ms)')
+        for name, scale, build, mean, p95 in self.results:
+            print '%8s %8s %12.2f %14.2f %14.2f' % (
+                name, '-' if scale is None else scale,
+                build * 1000, mean * 1000, p95 * 1000)
+        self.stop()
+
+if __name__ == '__main__':
+    GridBenchmark().run()
@@ -0,0 +1,164 @@
+'''
+Thumbnail atlas
+===============
+
+Slide thumbnails are packed in a few large textures, the pages of the
+atlas, instead of one texture and one Fbo per slide. Captures are drawn in
+a single thumbnail sized Fbo, the render target, and copied in a cell of a
+page with glCopyTexSubImage2D. A slide shows the region of its cell.
+
+The pages are limited by a memory budget. When it's reached, the least
+recently used cell is evicted: its owner is told with
+`thumb_evicted(atlas)` before the cell is reused, so it can keep a copy of
+the pixels.
+'''
+
+__all__ = ('ThumbnailAtlas', )
+
+from kivy.graphics import Fbo, Rectangle, Color
+from kivy.graphics.texture import Texture
+from kivy.graphics.opengl import glReadPixels, glBindTexture, \
+        glCopyTexSubImage2D, GL_RGBA, GL_UNSIGNED_BYTE
+from document import add_alpha
+
+
+class ThumbnailAtlas(object):
+    '''Allocate thumbnails of at most `cell_size` in pages of `page_size`,
+    using at most `budget` bytes of graphics memory for the pages.
+    '''
+
+    def __init__(self, cell_size=(160, 120), page_size=(1024, 1024),
+                 budget=64 * 1024 * 1024):
+        self.cell_size = cell_size
+        self.page_size = page_size
+        self.budget = budget
+        self.cols = page_size[0] // cell_size[0]
+        self.rows = page_size[1] // cell_size[1]
+        self.evictions = 0
+        self._pages = []
+        self._free = []
+        self._cells = {}
+        self._clock = 0
+        self.fbo = Fbo(size=cell_size)
+        with self.fbo:
+            Color(1, 1, 1)
+            Rectangle(size=cell_size)
+            self._rect = Rectangle(size=cell_size)
+
+    @property
+    def page_bytes(self):
+        return self.page_size[0] * self.page_size[1] * 4
+
+    def __contains__(self, owner):
+        return owner in self._cells
+
+    def render(self, owner, texture):
+        '''Draw the texture scaled in the cell of owner, and return the
+        texture region of the cell.
+        '''
+        fbo = self.fbo
+        self._rect.texture = texture
+        fbo.ask_update()
+        fbo.draw()
+        page, x, y = self._allocate(owner)
+        w, h = self.cell_size
+        fbo.bind()
+        target = page.texture.target
+        glBindTexture(target, page.texture.id)
+        glCopyTexSubImage2D(target, 0, x, y, 0, 0, w, h)
+        glBindTexture(target, 0)
+        fbo.release()
+        return page.texture.get_region(x, y, w, h)
+
+    def upload(self, owner, w, h, pixels, colorfmt='rgb'):
+        '''Copy the pixels in the cell of owner, and return the texture
+        region of the cell.
+        '''
+        if w > self.cell_size[0] or h > self.cell_size[1]:
+            # doesn't fit in a cell, use its own texture
+            texture = Texture.create((w, h), colorfmt, 'ubyte')
+            texture.blit_buffer(pixels, colorfmt=colorfmt)
+            return texture
+        if colorfmt == 'rgb':
+            # the pages are rgba, and OpenGL ES 2 only copies pixels of the
+            # format of the texture
+            pixels = add_alpha(pixels)
+            colorfmt = 'rgba'
+        page, x, y = self._allocate(owner)
+        page.texture.blit_buffer(pixels, size=(w, h), colorfmt=colorfmt,
+                                 pos=(x, y))
+        return page.texture.get_region(x, y, w, h)
+
+    def read(self, owner):
+        '''Return the RGBA pixels of the cell of owner as (w, h, pixels), or
+        None if it has no cell.
+        '''
+        cell = self._cells.get(owner)
+        if cell is None:
+            return None
+        page, x, y = self._cell_pos(cell[0], cell[1])
+        w, h = self.cell_size
+        page.bind()
+        pixels = glReadPixels(x, y, w, h, GL_RGBA, GL_UNSIGNED_BYTE)
+        page.release()
+        return w, h, pixels
+
+    def use(self, owner):
+        '''Mark the cell of owner as recently used.
+        '''
+        cell = self._cells.get(owner)
+        if cell is not None:
+            self._clock += 1
+            cell[2] = self._clock
+
+    def free(self, owner):
+        '''Release the cell of owner. Empty pages are released too, except
+        the first one.
+        '''
+        cell = self._cells.pop(owner, None)
+        if cell is None:
+            return
+        index, slot = cell[0], cell[1]
+        self._free[index].append(slot)
+        if index and len(self._free[index]) == self.cols * self.rows and \
+           index == len(self._pages) - 1:
+            self._pages.pop()
+            self._free.pop()
+
+    def stats(self):
+        '''Return the memory use of the atlas, as a dict.
+        '''
+        w, h = self.cell_size
+        return {'cells': len(self._cells), 'pages': len(self._pages),
+                'cells_per_page': self.cols * self.rows,
+                'gpu_bytes': len(self._pages) * self.page_bytes + w * h * 4,
+                'budget': self.budget, 'evictions': self.evictions}
+
+    def _cell_pos(self, index, slot):
+        w, h = self.cell_size
+        return (self._pages[index], (slot % self.cols) * w,
+                (slot // self.cols) * h)
+
+    def _allocate(self, owner):
+        self._clock += 1
+        cell = self._cells.get(owner)
+        if cell is None:
+            cell = self._cells[owner] = self._new_cell()
+        cell[2] = self._clock
+        return self._cell_pos(cell[0], cell[1])
+
+    def _new_cell(self):
+        for index, free in enumerate(self._free):
+            if free:
+                return [index, free.pop(), 0]
+        if not self._pages or \
+           (len(self._pages) + 1) * self.page_bytes <= self.budget:
+            self._pages.append(Fbo(size=self.page_size))
+            self._free.append(range(self.cols * self.rows - 1, -1, -1))
+            return [len(self._pages) - 1, self._free[-1].pop(), 0]
+        # over budget, reuse the least recently used cell
+        owner, cell = min(self._cells.iteritems(), key=lambda x: x[1][2])
+        owner.thumb_evicted(self)
+        del self._cells[owner]
+        self.evictions += 1
+        return cell
@@ -0,0 +1,138 @@
+'''
+Autosave
+========
+
+While a project is edited, a recovery snapshot of it is saved regularly in
+the `.recovery` directory of the workspace, and removed when the project is
+saved or its changes are discarded. A snapshot still there on the next
+launch means the application stopped with unsaved changes.
+
+The snapshots are not written on every change: Autosave waits for the
+changes to stop, and limits how often they are written.
+'''
+
+__all__ = ('Autosave', 'Recovery')
+
+import json
+from os import listdir, makedirs, remove
+from os.path import join, exists, basename, dirname
+from shutil import rmtree
+from time import time
+from kivy.clock import Clock
+from document import ThumbnailContainer, replace_file
+
+
+class Autosave(object):
+    '''Call `callback` once the changes stopped for `delay` seconds, or at
+    the latest `max_delay` seconds after the first change, and not more than
+    once every `interval` seconds. touch() is called on every change, it
+    only stores the time of the change.
+    '''
+
+    def __init__(self, callback, delay=3., max_delay=30., interval=10.):
+        self.callback = callback
+        self.delay = delay
+        self.max_delay = max_delay
+        self.interval = interval
+        self._first = None
+        self._last = None
+        self._done = 0
+
+    def touch(self):
+        now = time()
+        self._last = now
+        if self._first is None:
+            self._first = now
+            Clock.schedule_once(self._check, self.delay)
+
+    def cancel(self):
+        Clock.unschedule(self._check)
+        self._first = None
+
+    def _check(self, dt):
+        if self._first is None:
+            return
+        now = time()
+        due = min(self._last + self.delay, self._first + self.max_delay)
+        due = max(due, self._done + self.interval)
+        if now < due:
+            Clock.schedule_once(self._check, due - now)
+            return
+        self._first = None
+        self._done = now
+        self.callback()
+
+
+class Recovery(object):
+    '''Recovery snapshot of a project: a project.json, with a recovery.json
+    holding the `filename` of the project (None if it was never saved), the
+    `time` and the `generation` of the snapshot.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.filename = join(directory, 'project.json')
+        self.meta_filename = join(directory, 'recovery.json')
+
+    @staticmethod
+    def get_directory(workspace):
+        return join(workspace, '.recovery')
+
+    @staticmethod
+    def for_project(workspace, filename):
+        '''Return the Recovery of a project filename, or of a new project if
+        filename is None.
+        '''
+        if filename:
+            name = basename(dirname(filename))
+        else:
+            name = 'new_%d' % time()
+        return Recovery(join(Recovery.get_directory(workspace), name))
+
+    @staticmethod
+    def find(workspace):
+        '''Return the list of the complete snapshots of the workspace, the
+        most recent first.
+        '''
+        directory = Recovery.get_directory(workspace)
+        if not exists(directory):
+            return []
+        result = []
+        for item in listdir(directory):
+            recovery = Recovery(join(directory, item))
+            meta = recovery.load_meta()
+            if meta is not None and exists(recovery.filename):
+                result.append((meta['time'], recovery))
+        result.sort(reverse=True)
+        return [recovery for t, recovery in result]
+
+    def load_meta(self):
+        try:
+            with open(self.meta_filename, 'r') as fd:
+                return json.loads(fd.read())
+        except (IOError, ValueError):
+            return None
+
+    def write(self, doc, filename):
+        '''Save the document as the snapshot of the project filename. Each
+        snapshot is a new generation of the document, so an interrupted
+        write keeps the previous snapshot.
+        '''
+        if not exists(self.directory):
+            makedirs(self.directory)
+        meta = self.load_meta() or {}
+        previous = meta.get('generation', 0)
+        doc.infos.generation = previous
+        doc.save(self.filename)
+        tmp = self.meta_filename + '.tmp'
+        with open(tmp, 'w') as fd:
+            fd.write(json.dumps({'filename': filename, 'time': time(),
+                                 'generation': doc.infos.generation}))
+        replace_file(tmp, self.meta_filename)
+        try:
+            remove(ThumbnailContainer.get_filename(self.filename, previous))
+        except OSError:
+            pass
+
+    def remove(self):
+        rmtree(self.directory, True)
@@ -0,0 +1,160 @@
+'''
+Slide capture tracking
+======================
+
+A slide thumbnail is a capture of the plane seen from the slide viewport.
+It only needs to be captured again when something drawn in that viewport
+changed: an object moved into it, out of it, or changed inside it.
+
+For every captured slide, CaptureTracker keeps the viewport (4 corners in
+plane coordinates) and the objects that were in it. A changed object makes
+dirty the slides that captured it, for its old place, and the slides whose
+viewport overlaps its bounding box now, for its new place.
+
+Capturing a slide renders the whole plane, CaptureScheduler spreads the
+captures over the frames so the editor stays responsive.
+'''
+
+__all__ = ('CaptureTracker', 'CaptureScheduler')
+
+from time import time
+from kivy.clock import Clock
+from quadtree import QuadTree
+from geometry import polygon_bbox, obb_intersect
+
+
+class CaptureTracker(object):
+    '''Track the slides whose capture is out of date. Slides are any
+    hashable object, changed objects must have the `obb` and `bbox`
+    properties of the PlaneObject.
+    '''
+
+    def __init__(self):
+        self.size = None
+        self.dirty = set()
+        self._viewports = QuadTree()
+        self._quads = {}
+        self._captured = {}
+        self._users = {}
+
+    def __contains__(self, slide):
+        return slide in self._quads
+
+    def record(self, slide, quad, children):
+        '''Record the capture of a slide, made from the viewport quad and
+        showing the children.
+        '''
+        self.forget(slide)
+        self._quads[slide] = quad
+        self._viewports.insert(slide, polygon_bbox(quad))
+        self._captured[slide] = children = set(children)
+        users = self._users
+        for child in children:
+            users.setdefault(child, set()).add(slide)
+
+    def forget(self, slide):
+        '''Forget a slide, when it's removed or captured again.
+        '''
+        self.dirty.discard(slide)
+        if self._quads.pop(slide, None) is None:
+            return
+        self._viewports.remove(slide)
+        users = self._users
+        for child in self._captured.pop(slide):
+            slides = users[child]
+            slides.discard(slide)
+            if not slides:
+                del users[child]
+
+    def resize(self, size):
+        '''The viewports depend on the size of the window, all the slides
+        are dirty when it changed since they were captured.
+        '''
+        size = tuple(size)
+        if size != self.size:
+            self.size = size
+            self.invalidate()
+
+    def invalidate(self, slide=None):
+        '''Mark a slide dirty, or all the recorded slides if slide is None.
+        '''
+        if slide is None:
+            self.dirty.update(self._quads)
+        else:
+            self.dirty.add(slide)
+
+    def object_changed(self, obj):
+        '''Mark dirty the slides showing the object, before or after its
+        change. Removed objects are changed objects too.
+        '''
+        dirty = self.dirty
+        dirty.update(self._users.get(obj, ()))
+        obb = obj.obb
+        quads = self._quads
+        for slide in self._viewports.query(obj.bbox):
+            if slide not in dirty and obb_intersect(obb, quads[slide]):
+                dirty.add(slide)
+
+    def region_changed(self, bbox):
+        '''Mark dirty the slides overlapping the bounding box, for changes
+        not attached to an object, like the pen strokes.
+        '''
+        self.dirty.update(self._viewports.query(bbox))
+
+
+class CaptureScheduler(object):
+    '''Spread the capture of slides over the frames.
+
+    Slides added are captured on the next frames by `callback`, which gets
+    an iterator of slides and must capture them one after the other. The
+    iterator stops once `budget` seconds are spent in the frame, at least
+    one slide is captured per frame. Slides are given in the order of the
+    `priority` function, lower first. Adding a slide already waiting for
+    its capture doesn't capture it twice.
+    '''
+
+    def __init__(self, callback, priority=None, budget=.008):
+        self.callback = callback
+        self.priority = priority
+        self.budget = budget
+        self.pending = set()
+        self._scheduled = False
+
+    def add(self, slide):
+        self.pending.add(slide)
+        if not self._scheduled:
+            self._scheduled = True
+            Clock.schedule_once(self._run, 0)
+
+    def discard(self, slide):
+        self.pending.discard(slide)
+
+    def flush(self):
+        '''Capture all the waiting slides now.
+        '''
+        self.callback(self._jobs(None))
+
+    def _jobs(self, deadline):
+        pending = self.pending
+        slides = list(pending)
+        if self.priority is not None:
+            slides.sort(key=self.priority)
+        for slide in slides:
+            if slide not in pending:
+                continue
+            pending.discard(slide)
+            yield slide
+            if deadline is not None and time() >= deadline:
+                return
+
+    def _run(self, dt):
+        self._scheduled = False
+        count = len(self.pending)
+        if not count:
+            return
+        self.callback(self._jobs(time() + self.budget))
+        # don't spin on the clock if the callback didn't take any slide,
+        # the next add() schedules it again
+        if self.pending and len(self.pending) < count:
+            self._scheduled = True
+            Clock.schedule_once(self._run, 0)
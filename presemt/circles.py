@@ -0,0 +1,81 @@
+'''
+Circles
+=======
+
+Bounding circles of many items stored in NumPy arrays, to test them all
+against a viewport in one vectorized pass. NumPy is optional: check
+`CircleArray.available` before using it.
+'''
+
+__all__ = ('CircleArray', )
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class CircleArray(object):
+    '''Store a (x, y, radius) circle per item.
+    Adding, updating and removing an item is O(1).
+    '''
+
+    available = numpy is not None
+
+    def __init__(self, capacity=256):
+        self._data = numpy.zeros((capacity, 3), dtype=numpy.float64)
+        self._items = []
+        self._slots = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return item in self._slots
+
+    def update(self, item, x, y, radius):
+        '''Add or update the circle of an item.
+        '''
+        slot = self._slots.get(item)
+        if slot is None:
+            slot = len(self._items)
+            if slot == len(self._data):
+                data = numpy.zeros((slot * 2, 3), dtype=numpy.float64)
+                data[:slot] = self._data
+                self._data = data
+            self._slots[item] = slot
+            self._items.append(item)
+        self._data[slot] = (x, y, radius)
+
+    def remove(self, item):
+        '''Remove an item, the last item take its slot.
+        '''
+        slot = self._slots.pop(item, None)
+        if slot is None:
+            return
+        last = len(self._items) - 1
+        if slot != last:
+            moved = self._items[last]
+            self._items[slot] = moved
+            self._slots[moved] = slot
+            self._data[slot] = self._data[last]
+        self._items.pop()
+
+    def clear(self):
+        self._items = []
+        self._slots = {}
+
+    def query(self, x, y, radius):
+        '''Return the list of (item, distance) for the items whose circle
+        intersect the circle (x, y, radius). The distance is the one between
+        the two circles border, negative when they overlap.
+        '''
+        count = len(self._items)
+        if not count:
+            return []
+        data = self._data[:count]
+        dist = numpy.hypot(data[:, 0] - x, data[:, 1] - y) - data[:, 2]
+        indices = numpy.nonzero(dist <= radius)[0]
+        items = self._items
+        return [(items[i], d - radius)
+                for i, d in zip(indices.tolist(), dist[indices].tolist())]
@@ -10,11 +10,13 @@ Document:
     time_creation - int
     time_modification - int
     size - tuple(int, int)
+    generation - int, see Document.save()
 
 
     Objects:
 
         [ common attributes of all objects ]
+        uid - str, unique identifier of the object
         pos - tuple(float, float)
         size - tuple(float, float)
         rotation - float
@@ -34,59 +36,751 @@ Document:
         Video:
             source - str
 
+        Stroke:
+            points - list(int), see encode_points()
+            color - tuple(float, float, float, float)
+
     Slides:
         Slide:
             pos - tuple(float, float)
             rotation - float
             scale - float
+
+Journal
+-------
+
+Changes made after a save are appended to a journal instead of writing the
+whole document again, see Document.commit(). Each line of the journal is a
+json list of operations:
+
+    ('put', object) - add or replace the object with the same uid
+    ('del', uid) - remove an object
+    ('order', list(uid)) - objects order, from back to front
+    ('slides', list(slide)) - new list of slides
+    ('infos', dict) - updated document attributes
+
+Document.load() replays the journal on top of the json. Saving the whole
+document again starts a new generation, with an empty journal.
+
+The document can also be saved in a binary format instead of json, see
+document_binary.
 '''
 
-__all__ = ('Document', )
+__all__ = ('Document', 'Thumbnail', 'new_uid', 'encode_points',
+           'decode_points', 'strip_alpha', 'add_alpha', 'replace_file')
 
+import sys
 import json
+from array import array
+from itertools import chain
+from os import rename, remove, fsync, utime
+from os.path import splitext, exists, getsize
+from struct import Struct
+from threading import Lock
 from time import time
+from uuid import uuid4
 from kivy.utils import QueryDict
+from document_binary import BINARY_MAGIC, BinaryReader, BinaryWriter
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+JPEG_HEADER = 'data:image/jpeg;base64,'
+THUMBS_REF = 'thumbs:'
+THUMBS_MAGIC = 'PRESEMT-THUMBS-1'
+THUMBS_RECORD = Struct('<IHH')
+
+def new_uid():
+    '''Return a new unique identifier for an object.
+    '''
+    return uuid4().hex[:12]
+
+
+def replace_file(src, dst):
+    '''Rename src to dst, replacing dst if it exists. On Windows, rename()
+    fails when dst exists: MoveFileEx replaces it, or dst is removed
+    first if it can't be used.
+    '''
+    if sys.platform != 'win32':
+        rename(src, dst)
+        return
+    try:
+        import ctypes
+        encoding = sys.getfilesystemencoding()
+        # MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH
+        if ctypes.windll.kernel32.MoveFileExW(
+                src.decode(encoding) if isinstance(src, str) else src,
+                dst.decode(encoding) if isinstance(dst, str) else dst,
+                0x1 | 0x8):
+            return
+    except (ImportError, AttributeError):
+        pass
+    if exists(dst):
+        remove(dst)
+    rename(src, dst)
+
+
+def encode_points(points):
+    '''Encode a flat list of points [x0, y0, x1, y1, ...] for a stroke.
+    Coordinates are rounded to integers, and each point is stored as the
+    difference with the previous one, which keeps the numbers short.
+    '''
+    result = []
+    lx = ly = 0
+    for i in xrange(0, len(points) - 1, 2):
+        x = int(round(points[i]))
+        y = int(round(points[i + 1]))
+        result.extend((x - lx, y - ly))
+        lx, ly = x, y
+    return result
+
+
+def decode_points(data):
+    '''Decode points encoded with encode_points().
+    '''
+    result = []
+    x = y = 0
+    for i in xrange(0, len(data) - 1, 2):
+        x += data[i]
+        y += data[i + 1]
+        result.extend((x, y))
+    return result
+
+
+def strip_alpha(pixels):
+    '''Return the RGB pixels of RGBA pixels, as a string. The alpha is
+    dropped with a strided copy, done by NumPy if available.
+    '''
+    if numpy is not None:
+        rgba = numpy.frombuffer(pixels, dtype=numpy.uint8).reshape(-1, 4)
+        return rgba[:, :3].tostring()
+    rgba = bytearray(pixels)
+    rgb = bytearray(len(rgba) // 4 * 3)
+    rgb[0::3] = rgba[0::4]
+    rgb[1::3] = rgba[1::4]
+    rgb[2::3] = rgba[2::4]
+    return str(rgb)
+
+
+def add_alpha(pixels):
+    '''Return the RGBA pixels of RGB pixels, opaque, as a string. Reverse of
+    strip_alpha().
+    '''
+    if numpy is not None:
+        rgb = numpy.frombuffer(pixels, dtype=numpy.uint8).reshape(-1, 3)
+        rgba = numpy.empty((len(rgb), 4), dtype=numpy.uint8)
+        rgba[:, :3] = rgb
+        rgba[:, 3] = 255
+        return rgba.tostring()
+    rgb = bytearray(pixels)
+    rgba = bytearray('\xff' * (len(rgb) // 3 * 4))
+    rgba[0::4] = rgb[0::3]
+    rgba[1::4] = rgb[1::3]
+    rgba[2::4] = rgb[2::3]
+    return str(rgba)
+
+
+def encode_jpeg(w, h, pixels, quality, max_size):
+    '''Encode RGB or RGBA pixels (bottom to top rows, as read from OpenGL)
+    to JPEG in memory, scaled down to fit in max_size. The alpha is dropped.
+    Return (width, height, jpeg). PIL is used if available, otherwise pygame,
+    which ignores the quality.
+    '''
+    fmt = 'RGBA' if len(pixels) == w * h * 4 else 'RGB'
+    import StringIO
+    fd = StringIO.StringIO()
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+    if Image is not None:
+        frombytes = getattr(Image, 'frombytes', None) or Image.fromstring
+        image = frombytes(fmt, (w, h), pixels).convert('RGB')
+        image = image.transpose(Image.FLIP_TOP_BOTTOM)
+        if max(w, h) > max_size:
+            image.thumbnail((max_size, max_size),
+                            getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS)
+            w, h = image.size
+        image.save(fd, 'JPEG', quality=quality)
+        return w, h, fd.getvalue()
+    import pygame
+    surface = pygame.image.fromstring(pixels, (w, h), fmt, True)
+    if max(w, h) > max_size:
+        ratio = max_size / float(max(w, h))
+        w, h = max(1, int(w * ratio)), max(1, int(h * ratio))
+        surface = pygame.transform.smoothscale(surface, (w, h))
+    # pygame doesn't expose the quality, and need a name to pick the format
+    try:
+        pygame.image.save(surface, fd, 'thumb.jpg')
+    except TypeError:
+        # pygame < 2.0 only saves to a filename
+        from tempfile import mkstemp
+        from os import close
+        handle, filename = mkstemp(suffix='.jpg')
+        close(handle)
+        try:
+            pygame.image.save(surface, filename)
+            with open(filename, 'rb') as tmp:
+                return w, h, tmp.read()
+        finally:
+            remove(filename)
+    return w, h, fd.getvalue()
+
+
+def decode_jpeg(jpeg):
+    '''Decode JPEG data to RGB pixels, bottom to top rows.
+    '''
+    import StringIO
+    fd = StringIO.StringIO(jpeg)
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+    if Image is not None:
+        image = Image.open(fd).convert('RGB')
+        image = image.transpose(Image.FLIP_TOP_BOTTOM)
+        tobytes = getattr(image, 'tobytes', None) or image.tostring
+        return tobytes()
+    import pygame
+    surface = pygame.image.load(fd, 'image.jpg')
+    return pygame.image.tostring(surface, 'RGB', True)
+
+
+def parallel_map(func, items, workers):
+    '''Same as map(), using a pool of threads when there is more than one
+    item. Fall back to map() if threads pools are not available.
+    '''
+    if workers <= 1 or len(items) < 2:
+        return map(func, items)
+    try:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(workers, len(items)))
+    except (ImportError, OSError):
+        return map(func, items)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# value of the attributes not set in a record
+_missing = object()
+
+
+class DocumentObject(object):
+    '''Record of the attributes specific to a type of object, listed in
+    __attrs__. The attributes common to all the objects, listed in
+    common_attrs, are stored by the ObjectStore.
+    '''
+
+    __slots__ = ()
+
+    __attrs__ = ()
+
+    common_attrs = ('uid', 'pos', 'size', 'rotation', 'scale', 'dtype')
 
-class DocumentObject(QueryDict):
-    __attrs__ = ('pos', 'size', 'rotation', 'scale', 'dtype')
     def __init__(self, **kwargs):
-        super(DocumentObject, self).__init__(**kwargs)
-        allowed_attrs = list(self.__class__.__attrs__) + \
-                list(super(self.__class__, self).__attrs__)
-        if [x for x in self.keys() if x not in allowed_attrs]:
-            raise Exception('You are using non allowed attributes for your '
-                            'object')
+        self.update(kwargs)
+
+    def update(self, attrs):
+        for key, value in attrs.iteritems():
+            if key not in self.__attrs__:
+                raise Exception('You are using non allowed attributes for '
+                                'your object')
+            setattr(self, key, value)
+
+    def items(self):
+        '''Return the (attribute, value) list of the attributes set.
+        '''
+        items = [(attr, getattr(self, attr, _missing))
+                 for attr in self.__attrs__]
+        return [item for item in items if item[1] is not _missing]
+
 
 class TextObject(DocumentObject):
-    __attrs__ = ('text', 'bold', 'color', 'font_name', 'font_size', 'italic')
+    __attrs__ = __slots__ = ('text', 'bold', 'color', 'font_name',
+                             'font_size', 'italic')
 
 
 class ImageObject(DocumentObject):
-    __attrs__ = ('source', )
+    __attrs__ = __slots__ = ('source', )
 
 
 class VideoObject(DocumentObject):
-    __attrs__ = ('source', )
+    __attrs__ = __slots__ = ('source', )
+
+
+class StrokeObject(DocumentObject):
+    __attrs__ = __slots__ = ('points', 'color')
+
+
+class _PartialRecord(tuple):
+    # record with attributes not set, see ObjectStore
+    __slots__ = ()
+
+
+class ObjectStore(object):
+    '''Objects of a document, by uid. The transform of the objects (pos,
+    size, rotation and scale) is stored in a typed array, 6 numbers per
+    object, and the other attributes in a record: the tuple of the values of
+    the __attrs__ of their type. When some are not set, the record is a
+    _PartialRecord with _missing for them.
+    '''
+
+    common_attrs = frozenset(DocumentObject.common_attrs)
+
+    # values of the transform attributes not given
+    defaults = (0., 0., 100., 100., 0., 1.)
+
+    def __init__(self):
+        # the same string value is stored once
+        self._strings = {}
+        # (__attrs__, their set, allowed attributes) of each type
+        self._types = {}
+        self._rows = {}
+        self._uids = []
+        self._dtypes = []
+        self._records = []
+        self._transforms = array('d')
+
+    def __len__(self):
+        return len(self._uids)
+
+    def __contains__(self, uid):
+        return uid in self._rows
+
+    def _get_type(self, dtype):
+        attrs = Document.available_objects[dtype].__attrs__
+        info = self._types[dtype] = (attrs, frozenset(attrs),
+                                     self.common_attrs.union(attrs))
+        return info
+
+    def put(self, attrs):
+        '''Add an object from a dict of its attributes, or replace the
+        object with the same uid.
+        '''
+        uid = attrs['uid']
+        dtype = attrs['dtype']
+        names, required, allowed = \
+                self._types.get(dtype) or self._get_type(dtype)
+        if not allowed.issuperset(attrs):
+            raise Exception('You are using non allowed attributes for '
+                            'your object')
+        strings = self._strings
+        get = attrs.get
+        # font names, sources... are shared by many objects
+        record = tuple([strings.setdefault(value, value)
+                        if isinstance(value, basestring) else value
+                        for value in [get(name, _missing) for name in names]])
+        if not required.issubset(attrs):
+            record = _PartialRecord(record)
+        defaults = self.defaults
+        pos = get('pos') or defaults[0:2]
+        size = get('size') or defaults[2:4]
+        transform = (pos[0], pos[1], size[0], size[1],
+                     get('rotation', defaults[4]), get('scale', defaults[5]))
+        dtype = strings.setdefault(dtype, dtype)
+        row = self._rows.get(uid)
+        if row is None:
+            self._rows[uid] = len(self._uids)
+            self._uids.append(uid)
+            self._dtypes.append(dtype)
+            self._records.append(record)
+            self._transforms.extend(transform)
+        else:
+            self._dtypes[row] = dtype
+            self._records[row] = record
+            self._transforms[row * 6:row * 6 + 6] = array('d', transform)
+
+    def extend(self, objects):
+        '''Add objects from dicts of their attributes, like put(), when
+        loading a document: the attributes of the registered types are not
+        checked. Return the uids of the objects added, the objects with the
+        uid of an object already stored replace it.
+        '''
+        rows = self._rows
+        uids = self._uids
+        dtypes = self._dtypes
+        records = self._records
+        transforms = self._transforms
+        strings = self._strings
+        types = self._types
+        defaults = self.defaults
+        added = []
+        for attrs in objects:
+            uid = attrs['uid']
+            dtype = attrs['dtype']
+            info = types.get(dtype)
+            if uid in rows or info is None:
+                if uid not in rows:
+                    added.append(uid)
+                self.put(attrs)
+                continue
+            names, required, allowed = info
+            get = attrs.get
+            record = tuple([strings.setdefault(value, value)
+                            if isinstance(value, basestring) else value
+                            for value in [get(name, _missing)
+                                          for name in names]])
+            if not required.issubset(attrs):
+                record = _PartialRecord(record)
+            pos = get('pos') or defaults[0:2]
+            size = get('size') or defaults[2:4]
+            rows[uid] = len(uids)
+            uids.append(uid)
+            dtypes.append(strings.setdefault(dtype, dtype))
+            records.append(record)
+            transforms.extend((pos[0], pos[1], size[0], size[1],
+                               get('rotation', defaults[4]),
+                               get('scale', defaults[5])))
+            added.append(uid)
+        return added
+
+    def get(self, uid):
+        '''Return the attributes of an object as a QueryDict.
+        '''
+        row = self._rows[uid]
+        dtype = self._dtypes[row]
+        x, y, w, h, rotation, scale = self._transforms[row * 6:row * 6 + 6]
+        record = self._records[row]
+        items = zip(self._types[dtype][0], record)
+        if record.__class__ is not tuple:
+            items = [item for item in items if item[1] is not _missing]
+        return QueryDict(items, uid=uid, dtype=dtype, pos=(x, y),
+                         size=(w, h), rotation=rotation, scale=scale)
+
+    def remove(self, uid):
+        '''Remove an object, the last object takes its row.
+        '''
+        row = self._rows.pop(uid, None)
+        if row is None:
+            return False
+        last = len(self._uids) - 1
+        if row != last:
+            moved = self._uids[last]
+            self._rows[moved] = row
+            self._uids[row] = moved
+            self._dtypes[row] = self._dtypes[last]
+            self._records[row] = self._records[last]
+            self._transforms[row * 6:row * 6 + 6] = self._transforms[-6:]
+        self._uids.pop()
+        self._dtypes.pop()
+        self._records.pop()
+        del self._transforms[-6:]
+        return True
 
 
 class DocumentSlide(QueryDict):
     pass
 
 
+class ThumbnailCache(object):
+    '''Keep the pixels of the last `size` decoded thumbnails, and release the
+    pixels of the older ones.
+    '''
+
+    def __init__(self, size=32):
+        self.size = size
+        self._thumbs = []
+
+    def touch(self, thumb):
+        thumbs = self._thumbs
+        if thumb in thumbs:
+            thumbs.remove(thumb)
+        thumbs.append(thumb)
+        while len(thumbs) > self.size:
+            thumbs.pop(0).release()
+
+    def discard(self, thumb):
+        if thumb in self._thumbs:
+            self._thumbs.remove(thumb)
+
+
+class ThumbnailContainer(object):
+    '''Binary file holding the JPEG thumbnails of a project, next to the
+    project json. The file starts with THUMBS_MAGIC, then each thumbnail is
+    a record header (see THUMBS_RECORD) followed by the JPEG data. Records
+    are referenced by their offset, and read from a memory map of the file.
+    Records can be appended to an existing container.
+
+    The container is shared by the threads saving the project and the main
+    thread, the memory map is only used and replaced under a lock.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = None
+        self._map = None
+        self._lock = Lock()
+
+    @staticmethod
+    def get_filename(filename, generation=0):
+        '''Return the container filename of a project filename, for a
+        generation of the project.
+        '''
+        if not generation:
+            return splitext(filename)[0] + '.thumbs'
+        return '%s.%d.thumbs' % (splitext(filename)[0], generation)
+
+    def _open(self):
+        import mmap
+        self._close()
+        self._fd = open(self.filename, 'rb')
+        self._map = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(THUMBS_MAGIC)] != THUMBS_MAGIC:
+            raise ValueError('%s is not a thumbnail container' %
+                             self.filename)
+
+    def read(self, offset):
+        '''Return (width, height, jpeg) of the record at offset.
+        '''
+        start = offset + THUMBS_RECORD.size
+        with self._lock:
+            if self._map is None or start > len(self._map):
+                # the record may have been appended after the mapping
+                self._open()
+            length, w, h = THUMBS_RECORD.unpack(self._map[offset:start])
+            if start + length > len(self._map):
+                self._open()
+            return w, h, self._map[start:start + length]
+
+    def append(self, thumbs):
+        '''Append the (width, height, jpeg) thumbnails at the end of the
+        container, and return the offset of each one. The container is
+        created if it doesn't exist.
+        '''
+        if not exists(self.filename):
+            return ThumbnailContainer.write(self.filename, thumbs)
+        offsets = []
+        with open(self.filename, 'ab') as fd:
+            fd.seek(0, 2)
+            offset = fd.tell()
+            for w, h, jpeg in thumbs:
+                offsets.append(offset)
+                fd.write(THUMBS_RECORD.pack(len(jpeg), w, h))
+                fd.write(jpeg)
+                offset += THUMBS_RECORD.size + len(jpeg)
+            fd.flush()
+            fsync(fd.fileno())
+        return offsets
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._map is not None:
+            self._map.close()
+            self._fd.close()
+            self._map = self._fd = None
+
+    @staticmethod
+    def write(filename, thumbs):
+        '''Write a container with the (width, height, jpeg) thumbnails, and
+        return the offset of each one. The file is replaced atomically.
+        '''
+        offsets = []
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as fd:
+            fd.write(THUMBS_MAGIC)
+            offset = len(THUMBS_MAGIC)
+            for w, h, jpeg in thumbs:
+                offsets.append(offset)
+                fd.write(THUMBS_RECORD.pack(len(jpeg), w, h))
+                fd.write(jpeg)
+                offset += THUMBS_RECORD.size + len(jpeg)
+        replace_file(tmp, filename)
+        return offsets
+
+
+class Journal(object):
+    '''Append-only journal of the changes made to a document since it was
+    saved. Each line is a json list of operations, written at once: if the
+    application stops in the middle of a write, only that line is lost.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @staticmethod
+    def get_filename(filename, generation=0):
+        '''Return the journal filename of a project filename, for a
+        generation of the project.
+        '''
+        return '%s.%d.journal' % (splitext(filename)[0], generation)
+
+    @property
+    def size(self):
+        try:
+            return getsize(self.filename)
+        except OSError:
+            return 0
+
+    def append(self, ops):
+        with open(self.filename, 'ab') as fd:
+            fd.write(json.dumps(ops) + '\n')
+            fd.flush()
+            fsync(fd.fileno())
+
+    def read(self):
+        '''Iterate over the list of operations of each line.
+        '''
+        if not exists(self.filename):
+            return
+        with open(self.filename, 'rb') as fd:
+            for line in fd:
+                if not line.endswith('\n'):
+                    # interrupted write
+                    break
+                try:
+                    ops = json.loads(line)
+                except ValueError:
+                    break
+                yield ops
+
+
+class Thumbnail(object):
+    '''Encoded slide thumbnail, decoded only when the pixels are accessed.
+    Iterating over a thumbnail gives (width, height, pixels), like a raw
+    thumbnail tuple.
+
+    The JPEG data is either given directly, or read from a
+    ThumbnailContainer record, or from an inline base64 data uri for
+    projects saved before the containers.
+    '''
+
+    __slots__ = ('width', 'height', '_jpeg', '_data', '_record', '_pixels')
+
+    cache = ThumbnailCache()
+
+    def __init__(self, width, height, jpeg=None, data=None, container=None,
+                 offset=None):
+        self.width = width
+        self.height = height
+        self._jpeg = jpeg
+        self._data = data
+        # (container, offset), replaced at once when the record moves
+        self._record = None
+        if container is not None:
+            self._record = (container, offset)
+        self._pixels = None
+
+    def __iter__(self):
+        return iter((self.width, self.height, self.pixels))
+
+    @property
+    def jpeg(self):
+        '''Encoded JPEG data of the thumbnail.
+        '''
+        if self._jpeg is not None:
+            return self._jpeg
+        if self._data is not None:
+            import base64
+            return base64.b64decode(self._data[len(JPEG_HEADER):])
+        container, offset = self._record
+        return container.read(offset)[2]
+
+    def get_offset(self, container):
+        '''Return the offset of the thumbnail record in the container, or
+        None if it isn't stored there.
+        '''
+        record = self._record
+        if record is not None and record[0] is container:
+            return record[1]
+
+    def set_record(self, container, offset):
+        '''Read the JPEG data from a container record from now on.
+        '''
+        self._record = (container, offset)
+        self._jpeg = self._data = None
+
+    def copy(self):
+        '''Return a thumbnail of the same JPEG data, without reading it.
+        Setting a record on the copy doesn't change this thumbnail.
+        '''
+        thumb = Thumbnail(self.width, self.height, jpeg=self._jpeg,
+                          data=self._data)
+        thumb._record = self._record
+        return thumb
+
+    @property
+    def pixels(self):
+        '''RGB pixels of the thumbnail, decoded on the first access.
+        '''
+        if self._pixels is None:
+            self._pixels = self.decode()
+        Thumbnail.cache.touch(self)
+        return self._pixels
+
+    def decode(self):
+        return decode_jpeg(self.jpeg)
+
+    def release(self):
+        '''Release the decoded pixels, they will be decoded again if needed.
+        '''
+        self._pixels = None
+        Thumbnail.cache.discard(self)
+
+    def to_json(self):
+        '''Return the thumbnail as (width, height, data uri).
+        '''
+        if self._data is not None:
+            return (self.width, self.height, self._data)
+        import base64
+        return (self.width, self.height,
+                JPEG_HEADER + base64.b64encode(self.jpeg))
+
+    @staticmethod
+    def from_json(thumb):
+        '''Create a thumbnail from (width, height, data uri).
+        '''
+        w, h, data = thumb
+        if not data.startswith(JPEG_HEADER):
+            return None
+        return Thumbnail(w, h, data=data)
+
+
 class Document(object):
     available_objects = {}
 
+    # JPEG quality of the encoded thumbnails
+    thumb_quality = 85
+
+    # bigger thumbnails are scaled down to fit in this size before encoding
+    thumb_max_size = 160
+
+    # number of threads used to encode the thumbnails on save
+    thumb_workers = 4
+
+    # the journal is worth compacting once it reaches this size, or half the
+    # size of the json
+    journal_compact_size = 65536
+
     def __init__(self, **kwargs):
         self.infos = QueryDict()
         self.infos.version = 1
+        self.infos.generation = 0
         self.infos.time_creation = time()
         self.infos.time_modification = time()
         self.infos.root_size = kwargs.get('size', (100, 100))
         self.infos.root_pos = kwargs.get('pos', (0, 0))
         self.infos.root_scale = kwargs.get('scale', 0.)
         self.infos.root_rotation = kwargs.get('rotation', 0.)
-        self._objects = []
+        self.filename = None
+        # saved with the binary format, see document_binary
+        self.binary = False
+        # objects, and their uid from back to front
+        self._objects = ObjectStore()
+        self._order = []
         self._slides = []
+        self._container = None
+        self._journal = None
+        # operations not written in the journal yet
+        self._ops = []
+        # files of the previous generation, see cleanup()
+        self._obsolete = []
 
     @staticmethod
     def register(name, cls):
@@ -94,110 +788,399 @@ class Document(object):
 
     @property
     def objects(self):
-        return (QueryDict(x) for x in self._objects)
+        return (self._objects.get(uid) for uid in self._order)
 
     @property
     def slides(self):
         return (QueryDict(x) for x in self._slides)
 
+    @property
+    def object_count(self):
+        return len(self._objects)
+
+    @property
+    def slide_count(self):
+        return len(self._slides)
+
     def load(self, filename):
-        with open(filename, 'r') as fd:
-            j = json.loads(fd.read())
-        self.infos.update(j['document'])
-        for slide in j['slides']:
-            thumb = slide['thumb']
+        '''Load a document saved in json or in the binary format, and
+        replay its journal.
+        '''
+        with open(filename, 'rb') as fd:
+            self.binary = fd.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+            fd.seek(0)
+            if self.binary:
+                records = BinaryReader(fd)
+                if records.version > self.infos.version:
+                    raise ValueError('%s: unsupported document version %d' %
+                                     (filename, records.version))
+            else:
+                j = json.loads(fd.read())
+                records = chain((('infos', j['document']), ),
+                                (('slide', x) for x in j['slides']),
+                                (('object', x) for x in j['objects']))
+            self.filename = filename
+            objects = []
+            for name, value in records:
+                if name == 'object':
+                    if 'uid' not in value:
+                        # saved before the uids, they only need to be stable
+                        value['uid'] = 'legacy-%d' % len(objects)
+                    objects.append(value)
+                elif name == 'slide':
+                    self._slides.append(self._load_slide(value))
+                elif name == 'infos':
+                    self.infos.update(value)
+                    generation = self.infos.generation
+                    self._container = ThumbnailContainer(
+                        ThumbnailContainer.get_filename(filename, generation))
+                    self._journal = Journal(
+                        Journal.get_filename(filename, generation))
+        self._order.extend(self._objects.extend(objects))
+        for ops in self._journal.read():
+            self.apply(ops)
+
+    @staticmethod
+    def read_generation(filename):
+        '''Return the generation of the document saved in filename, without
+        loading it. 0 is returned if the file can't be read.
+        '''
+        try:
+            with open(filename, 'rb') as fd:
+                if fd.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                    fd.seek(0)
+                    infos = json.loads(fd.read())['document']
+                    return infos.get('generation', 0)
+                fd.seek(0)
+                for name, value in BinaryReader(fd):
+                    if name == 'infos':
+                        return value.get('generation', 0)
+        except (IOError, ValueError, KeyError):
+            pass
+        return 0
+
+    def _load_slide(self, slide):
+        thumb = slide['thumb']
+        if thumb is None:
+            pass
+        elif thumb[2].startswith(THUMBS_REF):
+            w, h, ref = thumb
+            slide['thumb'] = Thumbnail(w, h, container=self._container,
+                                       offset=int(ref[len(THUMBS_REF):]))
+        else:
+            # thumbnail inlined in the json, before the containers
+            slide['thumb'] = self.decode_thumb(thumb)
+        return DocumentSlide(slide)
+
+    def _dump_slides(self, offsets):
+        slides = []
+        for slide in self._slides:
+            slide = DocumentSlide(slide)
+            thumb = slide.thumb
             if thumb is not None:
-                slide['thumb'] = self.decode_thumb(thumb)
-            self._slides.append(DocumentSlide(slide))
-        for obj in j['objects']:
-            # No dict comprehensions in 2.6 yet :'-(
-            kwargs = {}
-            for k, v in obj.iteritems():
-                kwargs[str(k)] = v
-            inst = Document.available_objects[obj['dtype']](**kwargs)
-            self._objects.append(inst)
-
-    def save(self, filename):
-        doc = QueryDict()
-        doc.document = self.infos
-        doc.document.time_modification = time()
-        doc.objects = self._objects
-        doc.slides = self._slides
-        with open(filename, 'w') as fd:
-            fd.write(json.dumps(doc))
+                slide.thumb = (thumb.width, thumb.height,
+                               THUMBS_REF + str(offsets[thumb]))
+            slides.append(slide)
+        return slides
+
+    def _put(self, obj):
+        new = obj['uid'] not in self._objects
+        # put() first, it raises for an object with unknown attributes
+        self._objects.put(obj)
+        if new:
+            self._order.append(obj['uid'])
+
+    def apply(self, ops):
+        '''Apply a list of journal operations on the document.
+        '''
+        for name, value in ops:
+            if name == 'put':
+                self._put(value)
+            elif name == 'del':
+                if self._objects.remove(value):
+                    self._order.remove(value)
+            elif name == 'order':
+                order = [uid for uid in value if uid in self._objects]
+                known = set(order)
+                order.extend(uid for uid in self._order if uid not in known)
+                self._order = order
+            elif name == 'slides':
+                self._slides = [self._load_slide(x) for x in value]
+            elif name == 'infos':
+                self.infos.update(value)
+
+    def save(self, filename, touch=True, progress=None, binary=None):
+        '''Save the whole document in filename, and the slide thumbnails in
+        a ThumbnailContainer next to it. The modification time is updated,
+        unless touch is False. If set, progress is called with the fraction
+        of the work done. The document is saved in json, or in the binary
+        format if binary is True. By default, the format it was loaded from
+        is kept.
+
+        Each save starts a new generation of the document, with its own
+        container and an empty journal. The files of the previous
+        generation are kept until cleanup() is called, the thumbnails may
+        still be read from them until then. Saving over a document written
+        by another Document continues the generations of the file.
+        '''
+        if self.filename != filename and exists(filename):
+            previous = Document.read_generation(filename)
+            self.infos.generation = previous
+            self._obsolete.append(
+                ThumbnailContainer.get_filename(filename, previous))
+            self._obsolete.append(Journal.get_filename(filename, previous))
+        self.encode_thumbs()
+        if progress:
+            progress(.5)
+        thumbs = [slide.thumb for slide in self._slides
+                  if slide.thumb is not None]
+        generation = self.infos.generation + 1
+        container = ThumbnailContainer(
+            ThumbnailContainer.get_filename(filename, generation))
+        offsets = dict(zip(thumbs, ThumbnailContainer.write(
+            container.filename,
+            [(t.width, t.height, t.jpeg) for t in thumbs])))
+        journal = Journal(Journal.get_filename(filename, generation))
+        if exists(journal.filename):
+            # left by an interrupted save of this generation
+            remove(journal.filename)
+        if progress:
+            progress(.75)
+
+        infos = QueryDict(self.infos)
+        infos.generation = generation
+        if touch:
+            infos.time_modification = time()
+        if binary is None:
+            binary = self.binary
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as fd:
+            if binary:
+                self._write_binary(fd, infos, offsets)
+            else:
+                doc = QueryDict()
+                doc.document = infos
+                doc.objects = [self._objects.get(uid) for uid in self._order]
+                doc.slides = self._dump_slides(offsets)
+                fd.write(json.dumps(doc))
+        replace_file(tmp, filename)
+
+        if self.filename == filename:
+            if self._container is not None:
+                self._obsolete.append(self._container)
+            self._obsolete.append(self._journal.filename)
+        for thumb, offset in offsets.iteritems():
+            thumb.set_record(container, offset)
+        self.infos.update(infos)
+        self.filename = filename
+        self.binary = binary
+        self._container = container
+        self._journal = journal
+        self._ops = []
+        if progress:
+            progress(1.)
+
+    def _write_binary(self, fd, infos, offsets):
+        writer = BinaryWriter(fd, infos.version)
+        writer.write_infos(infos)
+        for uid in self._order:
+            obj = self._objects.get(uid)
+            writer.write_object(obj, Document.available_objects[obj.dtype])
+        for slide in self._dump_slides(offsets):
+            writer.write_slide(slide)
+        writer.close()
+
+    def cleanup(self):
+        '''Remove the files of the previous generations.
+        '''
+        for item in self._obsolete:
+            if isinstance(item, ThumbnailContainer):
+                item.close()
+                item = item.filename
+            try:
+                remove(item)
+            except OSError:
+                pass
+        self._obsolete = []
+
+    def commit(self, touch=True, progress=None):
+        '''Append the changes made since the last save or commit to the
+        journal. New slide thumbnails are appended to the container. The
+        document must have been loaded or saved before.
+        '''
+        if not self._ops:
+            if progress:
+                progress(1.)
+            return
+        if touch:
+            self.set_infos(time_modification=time())
+        ops = self._ops
+        self._ops = []
+        for index, (name, value) in enumerate(ops):
+            if name == 'slides':
+                ops[index] = (name, self._commit_slides())
+                if progress:
+                    progress(.5)
+        self._journal.append(ops)
+        # the workspace index checks the json modification time
+        utime(self.filename, None)
+        if progress:
+            progress(1.)
+
+    def _commit_slides(self):
+        self.encode_thumbs()
+        container = self._container
+        offsets = {}
+        missing = []
+        for slide in self._slides:
+            thumb = slide.thumb
+            if thumb is None:
+                continue
+            offset = thumb.get_offset(container)
+            if offset is None:
+                missing.append(thumb)
+            else:
+                offsets[thumb] = offset
+        if missing:
+            new = container.append([(t.width, t.height, t.jpeg)
+                                    for t in missing])
+            for thumb, offset in zip(missing, new):
+                thumb.set_record(container, offset)
+                offsets[thumb] = offset
+        return self._dump_slides(offsets)
+
+    def need_compaction(self):
+        '''Return True if the journal is big enough to save the whole
+        document again.
+        '''
+        if self._journal is None:
+            return False
+        size = self._journal.size
+        if size < self.journal_compact_size:
+            return False
+        try:
+            return size > getsize(self.filename) // 2
+        except OSError:
+            return True
+
+    def set_infos(self, **infos):
+        changed = dict((k, v) for k, v in infos.iteritems()
+                       if self.infos.get(k) != v)
+        if changed:
+            self.infos.update(changed)
+            self._ops.append(('infos', changed))
+
+    def put_object(self, dtype, **attrs):
+        '''Add an object, or replace the object with the same uid.
+        '''
+        if not attrs.get('uid'):
+            attrs['uid'] = new_uid()
+        attrs['dtype'] = dtype
+        self._put(attrs)
+        obj = self._objects.get(attrs['uid'])
+        self._ops.append(('put', obj))
+        return obj
+
+    def remove_object(self, uid):
+        if not self._objects.remove(uid):
+            return
+        self._order.remove(uid)
+        self._ops.append(('del', uid))
+
+    def set_order(self, uids):
+        '''Set the order of the objects, from back to front. Like the
+        'order' operation, the objects not in uids, like the strokes, are
+        kept after them in their current order.
+        '''
+        order = [uid for uid in uids if uid in self._objects]
+        known = set(order)
+        order.extend(uid for uid in self._order if uid not in known)
+        if order == self._order:
+            return
+        self._order = order
+        self._ops.append(('order', order))
 
     def create_text(self, **attrs):
-        text = TextObject(**attrs)
-        text.dtype = 'text'
-        self._objects.append(text)
-        return text
+        return self.put_object('text', **attrs)
 
     def create_image(self, **attrs):
-        image = ImageObject(**attrs)
-        image.dtype = 'image'
-        self._objects.append(image)
-        return image
+        return self.put_object('image', **attrs)
 
     def create_video(self, **attrs):
-        video = VideoObject(**attrs)
-        video.dtype = 'video'
-        self._objects.append(video)
-        return video
+        return self.put_object('video', **attrs)
 
-    def encode_thumb(self, thumb):
-        import pygame
-        import tempfile
-        import os
-        import base64
+    def create_stroke(self, **attrs):
+        return self.put_object('stroke', **attrs)
 
+    def encode_thumb(self, thumb):
         w, h, pixels = thumb
-        # convert pixels to jpeg
-        surface = pygame.image.fromstring(pixels, (w, h), 'RGB', True)
-        fn = tempfile.mktemp('.jpg')
-        pygame.image.save(surface, fn)
-        # read jpeg
-        with open(fn) as fd:
-            data = fd.read()
-        # delete file
-        os.unlink(fn)
-        # convert to base64
-        data = base64.b64encode(data)
-        return (w, h, 'data:image/jpeg;base64,' + data)
+        w, h, data = encode_jpeg(w, h, pixels, self.thumb_quality,
+                                 self.thumb_max_size)
+        return Thumbnail(w, h, jpeg=data)
+
+    def encode_thumbs(self):
+        '''Encode the raw thumbnails added with add_slide(), in parallel on
+        thumb_workers threads.
+        '''
+        slides = [slide for slide in self._slides if slide.thumb is not None
+                  and not isinstance(slide.thumb, Thumbnail)]
+        thumbs = parallel_map(self.encode_thumb,
+                              [slide.thumb for slide in slides],
+                              self.thumb_workers)
+        for slide, thumb in zip(slides, thumbs):
+            slide.thumb = thumb
 
     def decode_thumb(self, thumb):
-        header = 'data:image/jpeg;base64,'
-        w, h, data = thumb
-        if not data.startswith('data:image/jpeg;base64,'):
-            return None
-        data = data[len(header):]
-        import base64
-        import StringIO
-        import pygame
-        data = StringIO.StringIO(base64.b64decode(data))
-        surface = pygame.image.load(data, 'image.jpg')
-        return (w, h, pygame.image.tostring(surface, 'RGB', True))
+        '''Return a Thumbnail for an encoded thumbnail. The thumbnail is not
+        decoded until its pixels are accessed.
+        '''
+        return Thumbnail.from_json(thumb)
 
     def add_slide(self, pos, rotation, scale, thumb):
-        if thumb is not None:
-            thumb = self.encode_thumb(thumb)
+        '''Add a slide. The thumbnail is either a Thumbnail, or a raw
+        (width, height, pixels) tuple encoded when the document is saved.
+        '''
         slide = DocumentSlide()
         slide.pos = pos
         slide.rotation = rotation
         slide.scale = scale
         slide.thumb = thumb
         self._slides.append(slide)
+        self._slides_changed()
         return slide
 
+    def set_slides(self, slides):
+        '''Replace the slides by a list of (pos, rotation, scale, thumb).
+        Nothing is recorded if the slides didn't change.
+        '''
+        current = [(tuple(x.pos), x.rotation, x.scale, x.thumb)
+                   for x in self._slides]
+        slides = [(tuple(pos), rotation, scale, thumb)
+                  for pos, rotation, scale, thumb in slides]
+        if current == slides:
+            return
+        self._slides = []
+        for slide in slides:
+            self.add_slide(*slide)
+
     def remove_slide(self, slide):
         self._slides.remove(slide)
+        self._slides_changed()
 
     def clear_slides(self):
-        self._slides = {}
+        self._slides = []
+        self._slides_changed()
+
+    def _slides_changed(self):
+        # the slides are written once per commit, with their thumbnails
+        if ('slides', None) not in self._ops:
+            self._ops.append(('slides', None))
 
 # register object that can be used in document
 Document.register('text', TextObject)
 Document.register('image', ImageObject)
 Document.register('video', VideoObject)
+Document.register('stroke', StrokeObject)
 
 if __name__ == '__main__':
     doc = Document()
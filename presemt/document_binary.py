@@ -0,0 +1,300 @@
+'''
+Binary document format
+======================
+
+Compact alternative to the json serialization of a Document. The file
+starts with BINARY_MAGIC and the schema version (the `version` of the
+document infos), followed by a stream of records, each one starting with a
+tag byte:
+
+    'i' value - document infos
+    't' name count attr... - type of object, numbered in order of appearance
+    'o' type uid x y w h rotation scale value... - object, one value per
+        attribute of its type
+    's' value - slide
+    'e' - end of the document
+
+The types are written from the `__attrs__` of the classes given to
+Document.register(), so registered types work without changes. The reader
+uses the attributes names found in the file, not the current ones.
+
+Values start with a tag byte too. Strings are interned: the first
+occurrence of a string is written, the next ones only refer to it. Lists of
+integers, like the points of the strokes, are written as little endian
+arrays of 16 or 32 bits integers.
+'''
+
+__all__ = ('BINARY_MAGIC', 'BinaryWriter', 'BinaryReader', 'is_binary')
+
+import sys
+from array import array
+from struct import Struct
+
+BINARY_MAGIC = 'PRESEMT-DOC\x00'
+
+_version = Struct('<H')
+_double = Struct('<d')
+_transform = Struct('<6d')
+
+# value tags
+_NONE = 'n'
+_TRUE = 't'
+_FALSE = 'f'
+_INT = 'i'
+_FLOAT = 'd'
+_STRING = 's'
+_STRING_REF = 'r'
+_STRING_ONCE = 'u'
+_LIST = 'l'
+_INT_LIST = 'p'
+_DICT = 'm'
+_MISSING = 'x'
+
+# attribute not set, written with the _MISSING tag. Not a string: one
+# character strings are shared, a value 'x' would be taken for it
+_missing = object()
+
+
+def is_binary(filename):
+    '''Return True if filename contains a binary document.
+    '''
+    with open(filename, 'rb') as fd:
+        return fd.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def _varint(value):
+    data = []
+    while value > 0x7f:
+        data.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    data.append(chr(value))
+    return ''.join(data)
+
+
+def _zigzag(value):
+    if value < 0:
+        return _varint((-value << 1) - 1)
+    return _varint(value << 1)
+
+
+class BinaryWriter(object):
+    '''Write a document to a file object, record after record.
+    '''
+
+    def __init__(self, fd, version):
+        self.fd = fd
+        self._strings = {}
+        self._types = {}
+        fd.write(BINARY_MAGIC)
+        fd.write(_version.pack(version))
+
+    def write_infos(self, infos):
+        self.fd.write('i' + self._value(infos))
+
+    def write_object(self, obj, cls):
+        '''Write an object, given as a dict of its attributes, of the
+        registered type cls.
+        '''
+        dtype = obj['dtype']
+        index = self._types.get(dtype)
+        if index is None:
+            index = self._types[dtype] = len(self._types)
+            attrs = cls.__attrs__
+            self.fd.write('t' + self._string(dtype) + _varint(len(attrs)) +
+                          ''.join(self._string(x) for x in attrs))
+        x, y = obj['pos']
+        w, h = obj['size']
+        data = ['o', _varint(index), self._string(obj['uid'], False),
+                _transform.pack(x, y, w, h, obj['rotation'], obj['scale'])]
+        for attr in cls.__attrs__:
+            value = obj.get(attr, _missing)
+            data.append(_MISSING if value is _missing else self._value(value))
+        self.fd.write(''.join(data))
+
+    def write_slide(self, slide):
+        self.fd.write('s' + self._value(slide))
+
+    def close(self):
+        self.fd.write('e')
+
+    def _string(self, value, intern=True):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        if not intern:
+            return _STRING_ONCE + _varint(len(value)) + value
+        index = self._strings.get(value)
+        if index is not None:
+            return _STRING_REF + _varint(index)
+        self._strings[value] = len(self._strings)
+        return _STRING + _varint(len(value)) + value
+
+    def _value(self, value):
+        if value is None:
+            return _NONE
+        if value is True:
+            return _TRUE
+        if value is False:
+            return _FALSE
+        if isinstance(value, (int, long)):
+            return _INT + _zigzag(value)
+        if isinstance(value, float):
+            return _FLOAT + _double.pack(value)
+        if isinstance(value, basestring):
+            return self._string(value)
+        if isinstance(value, dict):
+            return _DICT + _varint(len(value)) + ''.join(
+                self._string(k) + self._value(v)
+                for k, v in value.iteritems())
+        value = list(value)
+        if value and all(type(x) in (int, long) for x in value):
+            try:
+                if -0x8000 <= min(value) and max(value) < 0x8000:
+                    ints = array('h', value)
+                else:
+                    ints = array('i', value)
+            except OverflowError:
+                pass
+            else:
+                if sys.byteorder == 'big':
+                    ints.byteswap()
+                return _INT_LIST + ints.typecode + _varint(len(value)) + \
+                        ints.tostring()
+        return _LIST + _varint(len(value)) + \
+                ''.join(self._value(x) for x in value)
+
+
+class BinaryReader(object):
+    '''Read a document from a file object. Iterating gives the records as
+    ('infos', dict), ('object', dict) and ('slide', dict), read from the file
+    by chunks of `chunk_size` bytes.
+    '''
+
+    chunk_size = 65536
+
+    def __init__(self, fd):
+        self.fd = fd
+        self._buf = ''
+        self._pos = 0
+        self._strings = []
+        self._types = []
+        if self._read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError('not a binary document')
+        self.version = _version.unpack(self._read(_version.size))[0]
+
+    def _fill(self, size):
+        # try to have size bytes available from the current position
+        buf = self._buf[self._pos:]
+        while len(buf) < size:
+            data = self.fd.read(max(self.chunk_size, size - len(buf)))
+            if not data:
+                break
+            buf += data
+        self._buf = buf
+        self._pos = 0
+
+    def _read(self, size):
+        if self._pos + size > len(self._buf):
+            self._fill(size)
+            if size > len(self._buf):
+                raise ValueError('truncated binary document')
+        pos = self._pos
+        self._pos = pos + size
+        return self._buf[pos:pos + size]
+
+    def _varint(self):
+        # a varint is at most 10 bytes long
+        if self._pos + 10 > len(self._buf):
+            self._fill(10)
+        buf = self._buf
+        pos = self._pos
+        result = shift = 0
+        try:
+            while True:
+                byte = ord(buf[pos])
+                pos += 1
+                result |= (byte & 0x7f) << shift
+                if byte < 0x80:
+                    break
+                shift += 7
+        except IndexError:
+            raise ValueError('truncated binary document')
+        self._pos = pos
+        return result
+
+    def _zigzag(self):
+        value = self._varint()
+        if value & 1:
+            return -((value + 1) >> 1)
+        return value >> 1
+
+    def _string(self, tag):
+        if tag == _STRING_REF:
+            return self._strings[self._varint()]
+        value = self._read(self._varint()).decode('utf-8')
+        if tag == _STRING:
+            self._strings.append(value)
+        return value
+
+    def _value(self):
+        tag = self._read(1)
+        if tag == _NONE:
+            return None
+        if tag == _TRUE:
+            return True
+        if tag == _FALSE:
+            return False
+        if tag == _INT:
+            return self._zigzag()
+        if tag == _FLOAT:
+            return _double.unpack(self._read(_double.size))[0]
+        if tag in (_STRING, _STRING_REF, _STRING_ONCE):
+            return self._string(tag)
+        if tag == _LIST:
+            return [self._value() for i in xrange(self._varint())]
+        if tag == _INT_LIST:
+            ints = array(self._read(1))
+            count = self._varint()
+            ints.fromstring(self._read(count * ints.itemsize))
+            if sys.byteorder == 'big':
+                ints.byteswap()
+            return ints.tolist()
+        if tag == _DICT:
+            result = {}
+            for i in xrange(self._varint()):
+                key = self._string(self._read(1))
+                result[key] = self._value()
+            return result
+        if tag == _MISSING:
+            return _missing
+        raise ValueError('unknown value tag %r' % tag)
+
+    def __iter__(self):
+        while True:
+            tag = self._read(1)
+            if tag == 'e':
+                return
+            elif tag == 'i':
+                yield 'infos', self._value()
+            elif tag == 't':
+                name = self._string(self._read(1))
+                attrs = [self._string(self._read(1))
+                         for i in xrange(self._varint())]
+                self._types.append((name, attrs))
+            elif tag == 'o':
+                dtype, attrs = self._types[self._varint()]
+                obj = {'dtype': dtype, 'uid': self._string(self._read(1))}
+                x, y, w, h, rotation, scale = _transform.unpack(
+                    self._read(_transform.size))
+                obj['pos'] = (x, y)
+                obj['size'] = (w, h)
+                obj['rotation'] = rotation
+                obj['scale'] = scale
+                for attr in attrs:
+                    value = self._value()
+                    if value is not _missing:
+                        obj[attr] = value
+                yield 'object', obj
+            elif tag == 's':
+                yield 'slide', self._value()
+            else:
+                raise ValueError('unknown record tag %r' % tag)
@@ -0,0 +1,97 @@
+'''
+Geometry helpers
+================
+
+Small helpers working on polygons given as a list of (x, y) points.
+'''
+
+__all__ = ('polygon_bbox', 'point_in_polygon', 'convex_hull',
+           'convex_intersect', 'obb_intersect')
+
+
+def polygon_bbox(points):
+    '''Return the axis aligned bounding box (x1, y1, x2, y2) of the points.
+    '''
+    xs, ys = zip(*points)
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def point_in_polygon(x, y, points):
+    '''Even-odd test of the point x, y against the polygon. The crossing
+    rule is half-open, so the parity of a point in the union of polygons
+    sharing edges is the sum of its parities in each polygon.
+    '''
+    inside = False
+    x1, y1 = points[-1]
+    for x2, y2 in points:
+        if (y1 > y) != (y2 > y) and \
+           x < (x2 - x1) * (y - y1) / float(y2 - y1) + x1:
+            inside = not inside
+        x1, y1 = x2, y2
+    return inside
+
+
+def convex_hull(points):
+    '''Return the convex hull of the points, counter clockwise, using the
+    monotone chain algorithm.
+    '''
+    points = sorted(set(points))
+    if len(points) < 3:
+        return points
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    lower = []
+    for p in points:
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], p) <= 0:
+            lower.pop()
+        lower.append(p)
+    upper = []
+    for p in reversed(points):
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], p) <= 0:
+            upper.pop()
+        upper.append(p)
+    return lower[:-1] + upper[:-1]
+
+
+def _separated(a, b, edges):
+    # check if one of the first edges normal of polygon a separates a and b
+    count = len(a)
+    for i in xrange(edges):
+        x1, y1 = a[i]
+        x2, y2 = a[(i + 1) % count]
+        nx = y1 - y2
+        ny = x2 - x1
+        amin = amax = nx * x1 + ny * y1
+        for x, y in a:
+            p = nx * x + ny * y
+            if p < amin:
+                amin = p
+            elif p > amax:
+                amax = p
+        bmin = bmax = None
+        for x, y in b:
+            p = nx * x + ny * y
+            if bmin is None or p < bmin:
+                bmin = p
+            if bmax is None or p > bmax:
+                bmax = p
+        if bmax < amin or bmin > amax:
+            return True
+    return False
+
+
+def convex_intersect(a, b):
+    '''Return True if the convex polygons a and b intersect, using the
+    separating axis theorem. Oriented boxes are convex polygons of 4 points.
+    '''
+    return not (_separated(a, b, len(a)) or _separated(b, a, len(b)))
+
+
+def obb_intersect(a, b):
+    '''Same as convex_intersect() for two oriented boxes given as 4 points.
+    The opposite edges of a box are parallel, so only 2 axes per box are
+    checked.
+    '''
+    return not (_separated(a, b, 2) or _separated(b, a, 2))
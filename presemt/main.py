@@ -53,7 +53,7 @@ class PresemtApp(App):
             del self.screens[name]
 
     def show_start(self):
-        self.show('project.SelectorScreen')
+        return self.show('project.SelectorScreen')
 
     def delete_project(self, filename):
         if not filename.startswith(self.config.get('paths', 'workspace')):
@@ -71,6 +71,24 @@ class PresemtApp(App):
         self.unload('presentation.MainScreen')
         return self.show('presentation.MainScreen')
 
+    def recover_project(self, recovery):
+        '''Start editing a project from a recovery snapshot
+        '''
+        project = self.create_empty_project()
+        project.recover(recovery)
+        project.return_action = 'edit'
+        project.do_edit()
+
+    def offer_recovery(self):
+        '''Show the project selector, and ask what to do with the most
+        recent recovery snapshot, if any
+        '''
+        from autosave import Recovery
+        selector = self.show_start()
+        recoveries = Recovery.find(self.config.get('paths', 'workspace'))
+        if recoveries:
+            selector.ask_recover(recoveries[0])
+
     def play_project(self, filename):
         project = self.create_empty_project()
         project.return_action = 'menu'
@@ -94,7 +112,8 @@ class PresemtApp(App):
         if len(argv) > 1:
             self.edit_project(argv[1])
         else:
-            self.show('project.SelectorScreen')
+            # with the unsaved changes of the last run
+            self.offer_recovery()
 
 if __name__ in ('__main__', '__android__'):
     PresemtApp().run()
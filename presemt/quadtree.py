@@ -0,0 +1,186 @@
+'''
+QuadTree
+========
+
+Spatial index of axis aligned bounding boxes, used by the plane to find the
+objects near a region without walking every object.
+
+A bounding box is a tuple (x1, y1, x2, y2) with x1 <= x2 and y1 <= y2.
+Items are stored in the deepest node that fully contains their box. Items
+outside of the root bounds are kept in the root node, so the index works for
+any coordinate, it's just slower for far away objects.
+'''
+
+__all__ = ('QuadTree', 'bbox_overlap', 'bbox_union')
+
+
+def bbox_overlap(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def bbox_union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]),
+            max(a[2], b[2]), max(a[3], b[3]))
+
+
+class _Node(object):
+
+    __slots__ = ('bounds', 'depth', 'items', 'nodes')
+
+    def __init__(self, bounds, depth):
+        self.bounds = bounds
+        self.depth = depth
+        self.items = {}
+        self.nodes = None
+
+    def contains(self, bbox):
+        b = self.bounds
+        return b[0] <= bbox[0] and bbox[2] <= b[2] and \
+               b[1] <= bbox[1] and bbox[3] <= b[3]
+
+    def child_for(self, bbox):
+        # return the child node that fully contains the bbox, if any. The
+        # root holds boxes outside of its bounds, none of its children does
+        if self.nodes is None or not self.contains(bbox):
+            return None
+        x1, y1, x2, y2 = self.bounds
+        cx = (x1 + x2) / 2.
+        cy = (y1 + y2) / 2.
+        if bbox[2] < cx:
+            col = 0
+        elif bbox[0] >= cx:
+            col = 1
+        else:
+            return None
+        if bbox[3] < cy:
+            row = 0
+        elif bbox[1] >= cy:
+            row = 1
+        else:
+            return None
+        return self.nodes[row * 2 + col]
+
+    def split(self):
+        x1, y1, x2, y2 = self.bounds
+        cx = (x1 + x2) / 2.
+        cy = (y1 + y2) / 2.
+        depth = self.depth + 1
+        self.nodes = (
+            _Node((x1, y1, cx, cy), depth), _Node((cx, y1, x2, cy), depth),
+            _Node((x1, cy, cx, y2), depth), _Node((cx, cy, x2, y2), depth))
+
+
+class QuadTree(object):
+    '''Index items by bounding box.
+
+    :Parameters:
+        `bounds`: tuple, default to (-65536, -65536, 65536, 65536)
+            Region covered by the tree.
+        `max_items`: int, default to 8
+            Number of items a node can hold before being splitted.
+        `max_depth`: int, default to 12
+            Maximum depth of the tree.
+    '''
+
+    def __init__(self, bounds=(-65536, -65536, 65536, 65536), max_items=8,
+                 max_depth=12):
+        self.max_items = max_items
+        self.max_depth = max_depth
+        self._root = _Node(tuple(bounds), 0)
+        self._nodes = {}
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, item):
+        return item in self._nodes
+
+    def get_bbox(self, item):
+        '''Return the bounding box stored for the item.
+        '''
+        return self._nodes[item].items[item]
+
+    def insert(self, item, bbox):
+        '''Insert a new item, or update it if it's already in the tree.
+        '''
+        if item in self._nodes:
+            return self.update(item, bbox)
+        self._insert(self._root, item, tuple(bbox))
+
+    def _insert(self, node, item, bbox):
+        if node.contains(bbox):
+            child = node.child_for(bbox)
+            while child is not None:
+                node = child
+                child = node.child_for(bbox)
+        node.items[item] = bbox
+        self._nodes[item] = node
+        if node.nodes is None and len(node.items) > self.max_items and \
+           node.depth < self.max_depth:
+            self._split(node)
+
+    def _split(self, node):
+        node.split()
+        for item, bbox in list(node.items.items()):
+            child = node.child_for(bbox)
+            if child is None:
+                continue
+            del node.items[item]
+            self._insert(child, item, bbox)
+
+    def remove(self, item):
+        '''Remove an item from the tree. Unknown items are ignored.
+        '''
+        node = self._nodes.pop(item, None)
+        if node is not None:
+            del node.items[item]
+
+    def update(self, item, bbox):
+        '''Update the bounding box of an item.
+        '''
+        bbox = tuple(bbox)
+        node = self._nodes.get(item)
+        if node is None:
+            return self._insert(self._root, item, bbox)
+        # fast path: the item still belongs to the same node
+        if node.contains(bbox):
+            if node.child_for(bbox) is None:
+                node.items[item] = bbox
+                return
+        elif node is self._root:
+            node.items[item] = bbox
+            return
+        del node.items[item]
+        self._insert(self._root, item, bbox)
+
+    def clear(self):
+        '''Remove all the items.
+        '''
+        self._root = _Node(self._root.bounds, 0)
+        self._nodes = {}
+
+    def query(self, bbox):
+        '''Return the list of items whose bounding box overlap `bbox`.
+        '''
+        result = []
+        x1, y1, x2, y2 = bbox
+        stack = [self._root]
+        pop = stack.pop
+        append = result.append
+        while stack:
+            node = pop()
+            for item, b in node.items.iteritems():
+                if b[0] <= x2 and x1 <= b[2] and b[1] <= y2 and y1 <= b[3]:
+                    append(item)
+            if node.nodes is None:
+                continue
+            for child in node.nodes:
+                b = child.bounds
+                if b[0] <= x2 and x1 <= b[2] and b[1] <= y2 and y1 <= b[3]:
+                    stack.append(child)
+        return result
+
+    def query_point(self, x, y):
+        '''Return the list of items whose bounding box contain the point.
+        '''
+        return self.query((x, y, x, y))
@@ -0,0 +1,79 @@
+'''
+Scene
+=====
+
+Ordered set of the objects of the plane. Adding, removing, checking the
+membership, raising an object to the front and lowering it to the back are
+O(1). Iterating sorts the objects by z-order once, the result is cached
+until the order changes.
+'''
+
+__all__ = ('Scene', )
+
+
+class Scene(object):
+    '''Each object has an integer z-order, higher is nearer to the front.
+    Iterating goes from front to back, like the children list of a widget.
+    '''
+
+    def __init__(self):
+        self._orders = {}
+        self._front = 0
+        self._back = 0
+        # objects sorted from back to front, None when it needs a sort
+        self._sorted = []
+
+    def __len__(self):
+        return len(self._orders)
+
+    def __contains__(self, item):
+        return item in self._orders
+
+    def __iter__(self):
+        return reversed(self.get_sorted())
+
+    def __reversed__(self):
+        return iter(self.get_sorted())
+
+    def get_sorted(self):
+        '''Return the list of objects, sorted from back to front.
+        '''
+        if self._sorted is None:
+            self._sorted = sorted(self._orders, key=self._orders.get)
+        return self._sorted
+
+    def order(self, item):
+        '''Return the z-order of an object.
+        '''
+        return self._orders[item]
+
+    def add(self, item):
+        '''Add an object in front of the others.
+        '''
+        assert item not in self._orders
+        self._front += 1
+        self._orders[item] = self._front
+        if self._sorted is not None:
+            self._sorted.append(item)
+
+    def remove(self, item):
+        del self._orders[item]
+        self._sorted = None
+
+    def raise_to_front(self, item):
+        '''Move an object in front of the others.
+        '''
+        self._front += 1
+        self._orders[item] = self._front
+        self._sorted = None
+
+    def lower_to_back(self, item):
+        '''Move an object behind the others.
+        '''
+        self._back -= 1
+        self._orders[item] = self._back
+        self._sorted = None
+
+    def clear(self):
+        self._orders = {}
+        self._sorted = []
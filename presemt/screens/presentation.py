@@ -1,6 +1,7 @@
 from os.path import splitext
 from . import Screen
-from document import Document, TextObject, ImageObject, VideoObject
+from document import Document, Thumbnail, TextObject, ImageObject, \
+        VideoObject, encode_points, decode_points
 from kivy.core.window import Window
 from kivy.clock import Clock
 from kivy.factory import Factory
@@ -9,38 +10,59 @@ from kivy.properties import NumericProperty, ObjectProperty, \
         BooleanProperty, ListProperty, AliasProperty, OptionProperty
 from kivy.animation import Animation
 from functools import partial
+from threading import Thread
+from Queue import Queue, Empty
 from time import time
-from os.path import join
+from os.path import join, dirname, exists
 from os import makedirs
 
+from autosave import Autosave, Recovery
+from atlas import ThumbnailAtlas
+from capture import CaptureTracker, CaptureScheduler
 from config import SUPPORTED_VID, SUPPORTED_IMG
+from geometry import polygon_bbox, point_in_polygon
 import presentation_plane
 from presentation_panel import TextPanel, LocalFilePanel
 from presentation_objects import ImagePlaneObject, VideoPlaneObject, \
     TextPlaneObject
-from presentation_slides import Slide
-
-def point_inside_polygon(x,y,poly):
-    '''Taken from http://www.ariel.com.au/a/python-point-int-poly.html'''
-
-    n = len(poly)
-    inside = False
-
-    p1x = poly[0]
-    p1y = poly[1]
-    for i in xrange(0, n+2, 2):
-        p2x = poly[i % n]
-        p2y = poly[(i+1) % n]
-        if y > min(p1y,p2y):
-            if y <= max(p1y,p2y):
-                if x <= max(p1x,p2x):
-                    if p1y != p2y:
-                        xinters = (y-p1y)*(p2x-p1x)/(p2y-p1y)+p1x
-                    if p1x == p2x or x <= xinters:
-                        inside = not inside
-        p1x,p1y = p2x,p2y
-
-    return inside
+from presentation_slides import Deck, DeckSlide
+
+class Lasso(object):
+    '''Lasso selection on the plane, updated incrementally.
+
+    The lasso is always closed on its first point. Adding a point p after the
+    last point l changes the even-odd state only for the points inside the
+    triangle (first, l, p), so only the objects near the new edge are tested.
+    An object is selected when its 4 corners are inside the lasso.
+    '''
+
+    def __init__(self, plane, x, y):
+        self.plane = plane
+        self.first = self.last = (x, y)
+        self.count = 1
+        self.inside = {}
+
+    def add_point(self, x, y):
+        '''Add a point, and return the objects whose state may have changed.
+        '''
+        triangle = (self.first, self.last, (x, y))
+        self.last = (x, y)
+        self.count += 1
+        inside = self.inside
+        changed = self.plane.query_children(polygon_bbox(triangle))
+        for child in changed:
+            mask = inside.get(child, 0)
+            for index, (cx, cy) in enumerate(child.obb):
+                if point_in_polygon(cx, cy, triangle):
+                    mask ^= 1 << index
+            if mask:
+                inside[child] = mask
+            else:
+                inside.pop(child, None)
+        return changed
+
+    def is_selected(self, child):
+        return self.inside.get(child, 0) == 0b1111
 
 #
 # Main screen, act as a controler for everybody
@@ -63,6 +85,10 @@ class MainScreen(Screen):
 
     is_dirty = BooleanProperty(False)
 
+    is_saving = BooleanProperty(False)
+
+    save_progress = NumericProperty(0)
+
     plane = ObjectProperty(None)
 
     config = ObjectProperty(None)
@@ -86,8 +112,32 @@ class MainScreen(Screen):
         self._panel_text = None
         self._panel_localfile = None
         self._plane_animation = None
+        self._lasso = None
+        # saved document, and the changes made since it was saved
+        self._document = None
+        self._reset_changes()
+        # records of the objects for the snapshots, see _get_snapshot()
+        self._records = {}
+        self._records_changed = set()
+        self._save_thread = None
+        self._save_queue = None
+        self._save_slides = []
+        self._save_again = False
+        self._autosave = Autosave(self.do_autosave)
+        self._recovery = None
+        self._recovery_thread = None
+        # slides whose thumbnail is out of date
+        self._capture = CaptureTracker()
+        self._capture_jobs = CaptureScheduler(self._capture_slides,
+                                              self._capture_priority)
+        # captures are read back a frame later, when the gpu is done
+        self._readback_jobs = CaptureScheduler(self._download_thumbs,
+                                               budget=.002)
         self.trigger_slides = Clock.create_trigger(
             self.update_slides_capture, 1)
+        # slides, and their thumbnails on the graphics card
+        self.deck = Deck()
+        self.atlas = ThumbnailAtlas()
         super(MainScreen, self).__init__(**kwargs)
 
     def on_parent(self, instance, value):
@@ -120,12 +170,10 @@ class MainScreen(Screen):
                 return
             # left pad, previous page
             if code in (276, 280):
-                slide = self.get_slide_by_index(slide.index - 1)
-                self.select_slide(slide)
+                self.select_slide(self.deck.get(slide.index - 1))
             # right pad, next page
             elif code in (275, 281):
-                slide = self.get_slide_by_index(slide.index + 1)
-                self.select_slide(slide)
+                self.select_slide(self.deck.get(slide.index + 1))
             # space bar, focus current page
             elif code == 32:
                 self.select_slide(slide)
@@ -156,7 +204,15 @@ class MainScreen(Screen):
         self.modalquit = None
 
     def ask_quit(self, force=False):
-        if force is True or not self.is_dirty:
+        # a save in progress can still fail and leave changes to save
+        self.wait_save()
+        if force is True:
+            # the changes are discarded
+            self.discard_recovery()
+            self.app.show_start()
+            return
+        if not self.is_dirty:
+            # the changes are saved, and their recovery removed by _poll_save
             self.app.show_start()
             return
         if self.is_dirty:
@@ -167,10 +223,44 @@ class MainScreen(Screen):
                 self.add_widget(modalquit)
                 Animation(alpha=1, d=.5, t='out_cubic').start(modalquit)
 
+    def save_and_quit(self):
+        '''Save the project, and quit once it's written. If the save fails,
+        the changes and their recovery are kept.
+        '''
+        self.do_save()
+        self.wait_save()
+        if not self.is_dirty:
+            self.app.show_start()
+
     def set_dirty(self):
         if not self.is_edit:
             return
         self.is_dirty = True
+        self._autosave.touch()
+
+    def object_changed(self, obj):
+        self._changed.add(obj)
+        self._records_changed.add(obj)
+        self._capture.object_changed(obj)
+        self.trigger_slides()
+        self.set_dirty()
+
+    def order_changed(self, obj=None):
+        self._order_changed = True
+        if obj is not None:
+            self._capture.object_changed(obj)
+            self.trigger_slides()
+        self.set_dirty()
+
+    def region_changed(self, bbox):
+        self._capture.region_changed(bbox)
+        self.trigger_slides()
+
+    def _reset_changes(self):
+        self._changed = set()
+        self._removed = set()
+        self._order_changed = False
+        self._stroke_uids = set()
 
     def _create_object(self, cls, touch, **kwargs):
         self.set_dirty()
@@ -188,12 +278,28 @@ class MainScreen(Screen):
         else:
             obj.pos = self.plane.to_local(*self.center)
         self.plane.add_widget(obj)
+        self._changed.add(obj)
+        self._capture.object_changed(obj)
+        self.trigger_slides()
 
     def update_select(self):
         s = self.selection_points
-        for child in self.plane.children:
-            child.selected = point_inside_polygon(
-                child.x, child.y, s)
+        lasso = self._lasso
+        if lasso is None or lasso.first != (s[0], s[1]) or \
+           lasso.count > len(s) // 2:
+            # a new selection started
+            self.reset_lasso()
+            lasso = self._lasso = Lasso(self.plane, s[0], s[1])
+        for index in xrange(lasso.count * 2, len(s) - 1, 2):
+            for child in lasso.add_point(s[index], s[index + 1]):
+                child.selected = lasso.is_selected(child)
+
+    def reset_lasso(self):
+        if self._lasso is None:
+            return
+        for child in self._lasso.inside:
+            child.selected = False
+        self._lasso = None
 
     def selection_align(self):
         childs = [x for x in self.plane.children if x.selected]
@@ -209,8 +315,8 @@ class MainScreen(Screen):
     def cancel_selection(self):
         self.do_selection = False
         self.selection_points = [0, 0]
-        for child in self.plane.children:
-            child.selected = False
+        # the lasso also selected children culled from the plane
+        self.reset_lasso()
 
     def create_text(self, touch=None, **kwargs):
         self._create_object(TextPlaneObject, touch, **kwargs)
@@ -282,37 +388,286 @@ class MainScreen(Screen):
     # Save/Load
     #
 
+    def _get_object_record(self, obj):
+        # plain values of the object, copied on the main thread: the
+        # document is created from them later, see _record_attrs()
+        if isinstance(obj, TextPlaneObject):
+            dtype, cls = 'text', TextObject
+        elif isinstance(obj, ImagePlaneObject):
+            dtype, cls = 'image', ImageObject
+        elif isinstance(obj, VideoPlaneObject):
+            dtype, cls = 'video', VideoObject
+        else:
+            return None
+        values = []
+        for attr in cls.__attrs__:
+            value = getattr(obj, attr)
+            if isinstance(value, list):
+                value = tuple(value)
+            values.append(value)
+        return (dtype, obj.uid, tuple(obj.pos), tuple(obj.size),
+                obj.rotation, obj.scale, tuple(values))
+
+    @staticmethod
+    def _record_attrs(record):
+        dtype, uid, pos, size, rotation, scale, values = record
+        attrs = dict(zip(Document.available_objects[dtype].__attrs__,
+                         values))
+        attrs.update(uid=uid, pos=pos, size=size, rotation=rotation,
+                     scale=scale)
+        return dtype, attrs
+
+    def _get_object_attrs(self, obj):
+        record = self._get_object_record(obj)
+        if record is None:
+            return None, None
+        return self._record_attrs(record)
+
+    def _get_snapshot(self):
+        '''Return the plane transformation and the records of its objects,
+        from back to front, see _create_document(). The records are kept
+        between the snapshots, only the changed objects are read again.
+        '''
+        plane = self.plane
+        records = self._records
+        for obj in self._records_changed:
+            records.pop(obj, None)
+        self._records_changed = set()
+        result = []
+        for obj in reversed(plane.all_children):
+            if obj in records:
+                record = records[obj]
+            else:
+                record = records[obj] = self._get_object_record(obj)
+            if record is not None:
+                result.append(record)
+        return (tuple(self.size), tuple(plane.pos), plane.scale,
+                plane.rotation), result
+
+    @staticmethod
+    def _create_document(snapshot):
+        # new document with all the objects of the snapshot, but no slides
+        (size, pos, scale, rotation), records = snapshot
+        doc = Document(size=size, pos=pos, scale=scale, rotation=rotation)
+        for record in records:
+            dtype, attrs = MainScreen._record_attrs(record)
+            doc.put_object(dtype, **attrs)
+        return doc
+
     def do_save(self):
-        doc = Document(size=self.size, pos=self.plane.pos,
-                       scale=self.plane.scale, rotation=self.plane.rotation)
-        for obj in reversed(self.plane.all_children):
-            attrs = [ ('pos', obj.pos), ('size', obj.size),
-                ('rotation', obj.rotation), ('scale', obj.scale)]
-            if isinstance(obj, TextPlaneObject):
-                attrs += [(attr, getattr(obj, attr)) for attr in TextObject.__attrs__]
-                doc.create_text(**dict(attrs))
-            elif isinstance(obj, ImagePlaneObject):
-                attrs += [(attr, getattr(obj, attr)) for attr in ImageObject.__attrs__]
-                doc.create_image(**dict(attrs))
-            elif isinstance(obj, VideoPlaneObject):
-                attrs += [(attr, getattr(obj, attr)) for attr in VideoObject.__attrs__]
-                doc.create_video(**dict(attrs))
-
-        for obj in reversed(self.tb_slides.children):
-            obj.download_thumb()
-            doc.add_slide(obj.slide_pos, obj.slide_rotation,
-                          obj.slide_scale, obj.thumb)
-
-        ws = self.app.config.get('paths', 'workspace')
+        '''Save the project in the background.
+
+        The changes are collected and the slide thumbnails are read on the
+        main thread. Encoding the thumbnails and writing the files are done
+        in a thread, and reported back on the clock, see _poll_save(). Once
+        saved, only the changes are appended to the journal of the
+        document, which is compacted by the thread when it grows too much.
+        '''
+        if self.is_saving:
+            # the document belongs to the save thread until it's done
+            self._save_again = True
+            return
+        plane = self.plane
+        doc = self._document
+        if doc is None or doc.filename != self.filename:
+            doc = self._create_document(self._get_snapshot())
+            self._stroke_uids = set()
+        else:
+            doc.set_infos(root_size=list(self.size), root_pos=list(plane.pos),
+                          root_scale=plane.scale,
+                          root_rotation=plane.rotation)
+            for uid in self._removed:
+                doc.remove_object(uid)
+            for obj in self._changed:
+                if obj not in plane.all_children:
+                    continue
+                dtype, attrs = self._get_object_attrs(obj)
+                if dtype:
+                    doc.put_object(dtype, **attrs)
+            if self._order_changed:
+                doc.set_order(obj.uid for obj in reversed(plane.all_children))
+
+        uids = set()
+        for points, color, uid in plane.strokes.strokes:
+            uids.add(uid)
+            if uid not in self._stroke_uids:
+                doc.create_stroke(uid=uid, points=encode_points(points),
+                                  color=color)
+        for uid in self._stroke_uids - uids:
+            doc.remove_object(uid)
+
+        # the thumbnails being captured are saved up to date
+        self._capture_jobs.flush()
+        self._readback_jobs.flush()
+        slides = list(self.deck)
+        for obj in slides:
+            obj.download_thumb(self.atlas)
+        doc.set_slides([(obj.pos, obj.rotation, obj.scale, obj.thumb)
+                        for obj in slides])
+        self._save_slides = [(obj, obj.thumb) for obj in slides]
+
         if not self.filename:
+            ws = self.app.config.get('paths', 'workspace')
             project_dir = join(ws, 'project_%d' % time())
             makedirs(project_dir)
             self._filename = join(project_dir, 'project.json')
-        doc.save(self.filename)
+        self._document = doc
+        self._reset_changes()
+        self._stroke_uids = uids
+        # changes made from now on are for the next save
         self.is_dirty = False
+        self.is_saving = True
+        self.save_progress = 0
+        self._save_queue = Queue()
+        self._save_thread = Thread(target=self._save_document,
+                                   args=(doc, self.filename, self._save_queue))
+        self._save_thread.start()
+        Clock.schedule_interval(self._poll_save, 0)
+
+    @staticmethod
+    def _save_document(doc, filename, queue):
+        # in the save thread: only talk to the main thread through the queue
+        progress = lambda value: queue.put(('progress', value))
+        try:
+            if doc.filename is None:
+                doc.save(filename, progress=progress)
+            else:
+                doc.commit(progress=progress)
+                if doc.need_compaction():
+                    doc.save(filename, touch=False)
+        except Exception, e:
+            queue.put(('error', e))
+        else:
+            queue.put(('done', None))
+
+    def _poll_save(self, dt):
+        queue = self._save_queue
+        if queue is None:
+            return False
+        while True:
+            try:
+                status, value = queue.get_nowait()
+            except Empty:
+                return
+            if status == 'progress':
+                self.save_progress = value
+            else:
+                break
+        self._save_thread.join()
+        self._save_thread = self._save_queue = None
+        if status == 'error':
+            print '=== Save failed: %s' % value
+            # the next save will write everything again
+            self._document = None
+            self.is_dirty = True
+        else:
+            # the recovery thread may read the thumbnails of the previous
+            # generation, stop it before they are removed
+            self.discard_recovery()
+            self._document.cleanup()
+            if self.is_dirty:
+                # changed during the save, snapshot these changes again
+                self._autosave.touch()
+            # keep the encoded thumbnails for the next save, unless the slide
+            # was captured again in the meantime
+            for (obj, thumb), slide in zip(self._save_slides,
+                                           self._document.slides):
+                if obj.thumb is thumb:
+                    obj.thumb = slide.thumb
+            self.save_progress = 1
+        self._save_slides = []
+        self.is_saving = False
+        if self._save_again:
+            self._save_again = False
+            self.do_save()
+        return False
+
+    def do_autosave(self):
+        '''Write a recovery snapshot of the project in a thread. Slides
+        thumbnails that were not read back from the graphics card yet are
+        left out, the slides will be captured again when recovered.
+
+        Only the records of the changed objects are copied on the main
+        thread, the document is created and written by the thread, see
+        _get_snapshot() and _write_recovery().
+        '''
+        if not self.is_dirty:
+            return
+        if self._recovery_thread is not None and \
+           self._recovery_thread.is_alive():
+            self._autosave.touch()
+            return
+        if self._recovery is None:
+            ws = self.app.config.get('paths', 'workspace')
+            self._recovery = Recovery.for_project(ws, self.filename)
+        slides = []
+        for obj in self.deck:
+            thumb = obj.thumb
+            if isinstance(thumb, Thumbnail):
+                # the copy is saved, not the thumbnail of the project
+                thumb = thumb.copy()
+            slides.append((obj.pos, obj.rotation, obj.scale, thumb))
+        args = (self._recovery, self.filename, self._get_snapshot(),
+                list(self.plane.strokes.strokes), slides)
+        self._recovery_thread = Thread(target=self._write_recovery, args=args)
+        self._recovery_thread.daemon = True
+        self._recovery_thread.start()
+
+    @staticmethod
+    def _write_recovery(recovery, filename, snapshot, strokes, slides):
+        # in the recovery thread: the arguments are not changed by the main
+        # thread, the finished strokes are never modified
+        doc = MainScreen._create_document(snapshot)
+        for points, color, uid in strokes:
+            doc.create_stroke(uid=uid, points=encode_points(points),
+                              color=color)
+        for slide in slides:
+            doc.add_slide(*slide)
+        recovery.write(doc, filename)
+
+    def discard_recovery(self):
+        '''Remove the recovery snapshot, once the changes are saved or
+        discarded.
+        '''
+        self._autosave.cancel()
+        if self._recovery_thread is not None:
+            self._recovery_thread.join()
+            self._recovery_thread = None
+        if self._recovery is not None:
+            self._recovery.remove()
+            self._recovery = None
+
+    def recover(self, recovery):
+        '''Load a recovery snapshot. The project is saved where it was
+        before, and keeps the snapshot until then.
+        '''
+        self._load(recovery.filename)
+        filename = recovery.load_meta().get('filename')
+        if filename and not exists(dirname(filename)):
+            filename = None
+        self._filename = filename
+        self._document = None
+        self._recovery = recovery
+        self.is_dirty = True
+
+    def wait_save(self):
+        '''Wait for the end of the background save, and of the save started
+        again after it, if any.
+        '''
+        while self._save_thread is not None:
+            self._save_thread.join()
+            self._poll_save(0)
 
     def on_filename(self, instance, filename):
+        self._load(filename)
+        self.is_dirty = False
+
+    def _load(self, filename):
         start = time()
+        self._save_again = False
+        self.wait_save()
+        self._records = {}
+        self._records_changed = set()
         doc = Document()
         doc.load(filename)
         self.plane.size = doc.infos.root_size
@@ -320,7 +675,7 @@ class MainScreen(Screen):
         self.plane.rotation = doc.infos.root_rotation
         self.plane.pos = doc.infos.root_pos
         for obj in doc.objects:
-            attrs = [ ('pos', obj.pos), ('size', obj.size),
+            attrs = [ ('uid', obj.uid), ('pos', obj.pos), ('size', obj.size),
                 ('rotation', obj.rotation), ('scale', obj.scale)]
             if obj.dtype == 'text':
                 attrs += [(attr, obj[attr]) for attr in TextObject.__attrs__]
@@ -331,11 +686,19 @@ class MainScreen(Screen):
             elif obj.dtype == 'video':
                 attrs += [(attr, obj[attr]) for attr in VideoObject.__attrs__]
                 self.create_video(**dict(attrs))
+            elif obj.dtype == 'stroke':
+                self.plane.strokes.add(decode_points(obj.points), obj.color,
+                                       obj.uid)
         for obj in doc.slides:
             self.create_slide(pos=obj.pos, rotation=obj.rotation,
                               scale=obj.scale, thumb=obj.thumb)
-        self.is_dirty = False
+        self._document = doc
+        self._reset_changes()
+        self._stroke_uids = set(x[2] for x in self.plane.strokes.strokes)
+        # read the objects once while loading, not on the first autosave
+        self._get_snapshot()
         print '=== Loading time: %3.4s' % (time() - start)
+        self.print_thumbs_memory()
 
     #
     # Presentation
@@ -381,6 +744,12 @@ class MainScreen(Screen):
 
     def remove_object(self, obj):
         self.set_dirty()
+        self._changed.discard(obj)
+        self._removed.add(obj.uid)
+        self._records.pop(obj, None)
+        self._records_changed.discard(obj)
+        self._capture.object_changed(obj)
+        self.trigger_slides()
         self.plane.remove_widget(obj)
 
     def configure_object(self, obj):
@@ -404,29 +773,44 @@ class MainScreen(Screen):
         scale = scale or plane.scale
         rotation = rotation or plane.rotation
 
-        slide = Slide(ctrl=self,
-                      slide_pos=pos,
-                      slide_rotation=rotation,
-                      slide_scale=scale,
-                      thumb=thumb)
-        self.tb_slides.add_widget(slide)
-        self.update_slide_index()
+        slide = self.deck.add(DeckSlide(pos, rotation, scale, thumb))
+        self.tb_slides.trigger_refresh()
+        if thumb is None:
+            # without thumbnail, the slide captures the current viewport
+            current = (tuple(plane.pos), plane.rotation, plane.scale)
+            self._capture_slide(slide)
+            self._record_capture(slide)
+            self._readback_jobs.add(slide)
+            if current != (slide.pos, rotation, scale):
+                self._capture.invalidate(slide)
+                self.trigger_slides()
+        else:
+            # the thumbnail is uploaded when the slide is shown
+            self._record_capture(slide, False)
+        return slide
 
     def remove_slide(self, slide):
         self.set_dirty()
         self.unselect_slides()
-        self.tb_slides.remove_widget(slide)
-        self.update_slide_index()
+        self.deck.remove(slide)
+        self._capture.forget(slide)
+        self._capture_jobs.discard(slide)
+        self._readback_jobs.discard(slide)
+        self.atlas.free(slide)
+        self.tb_slides.trigger_refresh()
 
     def select_slide(self, slide):
         k = {'d': .5, 't': 'out_cubic'}
 
         # highlight slide
         self.unselect()
-        slide.selected = True
+        self.deck.selected = slide
+        if slide.view is not None:
+            slide.view.selected = True
+        slide.restore_thumb(self.atlas)
 
         # rotation must be fixed by hand
-        slide_rotation = slide.slide_rotation
+        slide_rotation = slide.rotation
         s = abs(slide_rotation - self.plane.rotation)
         if s > 180:
             if slide_rotation > self.plane.rotation:
@@ -434,12 +818,18 @@ class MainScreen(Screen):
             else:
                 slide_rotation += 360
 
+        # show everything that will be visible during the move, so we don't
+        # need to cull on every frame of the animation
+        plane = self.plane
+        plane.cull_children(visible=plane.get_transition_children(
+            slide.pos, slide_rotation, slide.scale))
+
         # move to the correct position in the place
-        self._plane_animation = Animation(pos=slide.slide_pos,
+        self._plane_animation = Animation(pos=slide.pos,
                  rotation=slide_rotation,
-                 scale=slide.slide_scale, **k)
-        self._plane_animation.bind(on_progress=self.plane.cull_children)
-        self._plane_animation.start(self.plane)
+                 scale=slide.scale, **k)
+        self._plane_animation.bind(on_complete=plane.cull_children)
+        self._plane_animation.start(plane)
 
     def unselect(self):
         self.selection_points = [0, 0]
@@ -447,17 +837,10 @@ class MainScreen(Screen):
         self.unselect_slides()
 
     def get_selected_slide(self):
-        for child in self.tb_slides.children:
-            if child.selected:
-                return child
-        if len(self.tb_slides.children):
-            return self.tb_slides.children[0]
+        return self.deck.current()
 
     def get_slide_by_index(self, index):
-        index = index % len(self.tb_slides.children)
-        for x in self.tb_slides.children:
-            if x.index == index:
-                return x
+        return self.deck.get(index)
 
     def go_next_slide(self):
         slide = self.get_selected_slide()
@@ -472,29 +855,97 @@ class MainScreen(Screen):
         self.select_slide(self.get_slide_by_index(slide.index - 1))
 
     def unselect_slides(self):
-        for child in self.tb_slides.children:
-            child.selected = False
-
-    def update_slide_index(self):
-        for idx, slide in enumerate(reversed(self.tb_slides.children)):
-            slide.index = idx
+        slide = self.deck.selected
+        self.deck.selected = None
+        if slide is not None and slide.view is not None:
+            slide.view.selected = False
+
+    def _record_capture(self, slide, current=True):
+        # record what the slide thumbnail shows: the current viewport, or
+        # the viewport of the slide
+        plane = self.plane
+        if current:
+            quad = plane.get_viewport_quad()
+        else:
+            quad = plane.get_viewport_quad_at(
+                slide.pos, slide.rotation, slide.scale)
+        if quad is None:
+            # not on a window, it will be captured again
+            self._capture.forget(slide)
+            return
+        self._capture.resize(plane.get_parent_window().size)
+        self._capture.record(slide, quad, plane.get_children_in_quad(quad))
 
     def update_slides_capture(self, *largs):
+        '''Capture again the slides showing something that changed since
+        their last capture. The captures are spread over the next frames,
+        see CaptureScheduler.
+        '''
         if not self.is_edit:
             return
-        pos = self.plane.pos
-        scale = self.plane.scale
-        rotation = self.plane.rotation
-        for slide in self.tb_slides.children:
-            self.plane.scale = slide.slide_scale
-            self.plane.rotation = slide.slide_rotation
-            self.plane.pos = slide.slide_pos
-            self.plane.cull_children(no_event=True)
-            slide.update_capture()
-        self.plane.scale = scale
-        self.plane.rotation = rotation
-        self.plane.pos = pos
-        self.plane.cull_children(no_event=True)
+        capture = self._capture
+        window = self.plane.get_parent_window()
+        if window is not None:
+            capture.resize(window.size)
+        for slide in self.deck:
+            if slide in capture.dirty or slide not in capture:
+                self._capture_jobs.add(slide)
+
+    def print_thumbs_memory(self):
+        stats = self.atlas.stats()
+        raw = 0
+        for slide in self.deck:
+            if isinstance(slide.thumb, tuple):
+                raw += len(slide.thumb[2])
+        print '=== Thumbnails: %d in %d pages, %.1f/%.1f MB on gpu, ' \
+              '%.1f MB raw, %d evicted' % (
+                  stats['cells'], stats['pages'],
+                  stats['gpu_bytes'] / 1048576., stats['budget'] / 1048576.,
+                  raw / 1048576., stats['evictions'])
+
+    def _capture_priority(self, slide):
+        # the selected slide first, then the slides shown in the sidebar
+        if slide is self.deck.selected:
+            return 0, slide.index
+        if slide.view is not None:
+            return 1, slide.index
+        return 2, slide.index
+
+    def _download_thumbs(self, slides):
+        for slide in slides:
+            slide.download_thumb(self.atlas)
+
+    def _capture_slide(self, slide):
+        # render the plane as it is now, in the cell of the slide
+        edit_mode = self.is_edit
+        self.is_edit = False
+        fbo = self.capture.fbo
+        fbo.ask_update()
+        fbo.draw()
+        slide.capture(self.atlas, fbo.texture)
+        self.is_edit = edit_mode
+        self.set_dirty()
+
+    def _capture_slides(self, slides):
+        # capture the slides, as long as the scheduler gives some
+        if not self.is_edit:
+            return
+        plane = self.plane
+        pos = plane.pos
+        scale = plane.scale
+        rotation = plane.rotation
+        for slide in slides:
+            plane.scale = slide.scale
+            plane.rotation = slide.rotation
+            plane.pos = slide.pos
+            plane.cull_children(no_event=True)
+            self._capture_slide(slide)
+            self._record_capture(slide)
+            self._readback_jobs.add(slide)
+        plane.scale = scale
+        plane.rotation = rotation
+        plane.pos = pos
+        plane.cull_children(no_event=True)
 
 
 class ModalQuit(FloatLayout):
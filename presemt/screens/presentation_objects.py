@@ -6,23 +6,74 @@ from kivy.uix.scatter import Scatter
 from kivy.properties import BooleanProperty, ObjectProperty, \
         StringProperty, ListProperty, NumericProperty
 
+from document import new_uid
+from geometry import polygon_bbox
+
 class PlaneObject(Scatter):
 
     selected = BooleanProperty(False)
 
     ctrl = ObjectProperty(None)
 
+    uid = StringProperty('')
+
     def __init__(self, **kwargs):
+        self._bounds = None
+        self._bounds_key = None
         super(PlaneObject, self).__init__(**kwargs)
         touch = kwargs.get('touch_follow', None)
         if touch:
             touch.ud.scatter_follow = self
             touch.grab(self)
-        self.bind(transform=self._on_transform)
+        if not self.uid:
+            self.uid = new_uid()
+        self.bind(transform=self._on_transform, size=self._on_transform)
 
     def _on_transform(self, instance, value):
         if self.ctrl:
-            self.ctrl.set_dirty()
+            self.ctrl.object_changed(self)
+
+    def get_bounds(self):
+        '''Return the bounding volumes (obb, bbox, circle) of the object in
+        plane coordinates. They are cached, and computed again only when the
+        transform or the size of the object changed.
+        '''
+        transform = self.transform
+        w, h = self.size
+        key = self._bounds_key
+        if key is not None and key[0] is transform and \
+           key[1] == w and key[2] == h:
+            return self._bounds
+        # the object is drawn centered on its local origin
+        w2 = w / 2.
+        h2 = h / 2.
+        to_parent = self.to_parent
+        obb = (to_parent(-w2, -h2), to_parent(w2, -h2),
+               to_parent(w2, h2), to_parent(-w2, h2))
+        (x1, y1), _, (x2, y2), _ = obb
+        circle = ((x1 + x2) / 2., (y1 + y2) / 2.,
+                  ((x2 - x1) ** 2 + (y2 - y1) ** 2) ** .5 / 2.)
+        self._bounds = obb, polygon_bbox(obb), circle
+        self._bounds_key = transform, w, h
+        return self._bounds
+
+    @property
+    def obb(self):
+        '''Oriented bounding box, as the 4 corners in plane coordinates.
+        '''
+        return self.get_bounds()[0]
+
+    @property
+    def bbox(self):
+        '''Axis aligned bounding box (x1, y1, x2, y2) in plane coordinates.
+        '''
+        return self.get_bounds()[1]
+
+    @property
+    def bounding_circle(self):
+        '''Bounding circle (x, y, radius) in plane coordinates.
+        '''
+        return self.get_bounds()[2]
 
     def collide_point(self, x, y):
         x, y = self.to_local(x, y)
@@ -2,14 +2,26 @@
 Scatter plane with grid
 '''
 
-from kivy.uix.scatter import ScatterPlane, Scatter
+from bisect import bisect, bisect_left
+from math import hypot, floor, ceil, radians, cos, sin
+from kivy.uix.scatter import ScatterPlane
 from kivy.properties import NumericProperty, BooleanProperty
-from kivy.vector import Vector
 from kivy.clock import Clock
-from kivy.graphics import Line, Color
+from kivy.graphics import Color, Canvas
+try:
+    from kivy.graphics import Mesh
+except ImportError:
+    # no batched grid on older kivy
+    Mesh = None
 from kivy.factory import Factory
 
 from presentation_objects import PlaneObject
+from presentation_strokes import StrokeLayer, points_bbox
+from scene import Scene
+from quadtree import QuadTree
+from circles import CircleArray
+from geometry import polygon_bbox, obb_intersect, convex_hull, \
+        convex_intersect
 
 
 class MainPlane(ScatterPlane):
@@ -18,34 +30,107 @@ class MainPlane(ScatterPlane):
 
     grid_count = NumericProperty(1000)
 
+    grid_min_distance = NumericProperty(16)
+
     children_locked = BooleanProperty(False)
 
+    cull_margin = NumericProperty(32)
+
+    cull_batch_threshold = NumericProperty(1000)
+
+    transition_steps = NumericProperty(16)
+
+    stroke_tolerance = NumericProperty(1.5)
+
     def __init__(self, **kwargs):
         self._trigger_grid = Clock.create_trigger(self.fill_grid, -1)
         self._trigger_cull = Clock.create_trigger(self.cull_children, -1)
         super(MainPlane, self).__init__(**kwargs)
         self.register_event_type('on_scene_enter')
         self.register_event_type('on_scene_leave')
-        self.all_children = []
+        self.all_children = Scene()
+        self._index = QuadTree()
+        # batched culling is only available with numpy
+        self._circles = CircleArray() if CircleArray.available else None
+        self._orders = []
+        self._visible = set()
+        # None until compute_viewport_quad() is checked, see
+        # get_viewport_quad_at()
+        self._viewport_computed = None
+        # the grid is drawn below everything else
+        self._grid_built = None
+        self.canvas_grid = Canvas()
+        self.canvas.insert(0, self.canvas_grid)
+        # children canvas are kept in their own group, sorted by z-order
+        self.canvas_objects = Canvas()
+        self.canvas.add(self.canvas_objects)
+        # pen strokes are drawn above the objects
+        self.strokes = StrokeLayer()
+        self.canvas.add(self.strokes.canvas)
+        self.bind(transform=self._trigger_grid, size=self._trigger_grid,
+                  grid_spacing=self._reset_grid, grid_count=self._reset_grid,
+                  grid_min_distance=self._reset_grid)
         self._trigger_grid()
         self._trigger_cull()
 
+    def _reset_grid(self, *largs):
+        self._grid_built = None
+        self._trigger_grid()
+
     def fill_grid(self, *largs):
-        # FIXME grid disable cause every line is in a different VBO
-        # That's cause lot of lags on many devices. Activate background
-        # grid as soon as we will be able to do one call-one draw
-        return
-        self.canvas.clear()
-        gs = self.grid_spacing
-        gc = self.grid_count * gs
-        count = 0
-        with self.canvas:
+        '''
+        Draw the background grid as a single Mesh of lines, covering the
+        viewport and half of its size around it. The spacing between lines is
+        doubled until lines are at least grid_min_distance pixels apart on
+        the screen, so zooming out never creates too many vertices. The mesh
+        is rebuilt only when the viewport leaves the built area or when the
+        level of detail changes.
+        '''
+        if Mesh is None:
+            return
+        bbox = self.get_viewport_bbox()
+        if bbox is None:
+            return
+        spacing = float(self.grid_spacing)
+        if spacing <= 0:
+            return
+        while spacing * self.scale < self.grid_min_distance:
+            spacing *= 2
+        limit = self.grid_count * self.grid_spacing
+        x1, y1, x2, y2 = bbox
+        x1, y1 = max(-limit, x1), max(-limit, y1)
+        x2, y2 = min(limit, x2), min(limit, y2)
+
+        built = self._grid_built
+        if built is not None and built[0] == spacing:
+            bx1, by1, bx2, by2 = built[1]
+            if bx1 <= x1 and by1 <= y1 and x2 <= bx2 and y2 <= by2:
+                return
+
+        self.canvas_grid.clear()
+        self._grid_built = None
+        if x1 > x2 or y1 > y2:
+            return
+        w2 = (x2 - x1) / 2.
+        h2 = (y2 - y1) / 2.
+        x1 = max(-limit, floor((x1 - w2) / spacing) * spacing)
+        y1 = max(-limit, floor((y1 - h2) / spacing) * spacing)
+        x2 = min(limit, ceil((x2 + w2) / spacing) * spacing)
+        y2 = min(limit, ceil((y2 + h2) / spacing) * spacing)
+
+        vertices = []
+        extend = vertices.extend
+        for i in xrange(int(round((x2 - x1) / spacing)) + 1):
+            x = x1 + i * spacing
+            extend((x, y1, 0, 0, x, y2, 0, 0))
+        for i in xrange(int(round((y2 - y1) / spacing)) + 1):
+            y = y1 + i * spacing
+            extend((x1, y, 0, 0, x2, y, 0, 0))
+        with self.canvas_grid:
             Color(.9, .9, .9, .2)
-            for x in xrange(-gc, gc, gs):
-                Line(points=(x, -gc, x, gc))
-                Line(points=(-gc, x, gc, x))
-                count += 2
-
+            Mesh(vertices=vertices, indices=range(len(vertices) / 4),
+                 mode='lines')
+        self._grid_built = spacing, (x1, y1, x2, y2)
 
     #
     # In order to maneuver more easily with a lot of widgets on the screen, we
@@ -71,6 +156,21 @@ class MainPlane(ScatterPlane):
             return self.on_touch_up_pen(touch)
         return self.on_touch_up_touch(touch)
 
+    def dispatch_children(self, name, touch):
+        '''
+        Dispatch a touch event, already in plane coordinates, to the shown
+        children whose bounding box contain the touch, from front to back.
+        The children do the exact collision test themselves.
+        '''
+        shown = self._visible
+        candidates = [child for child in self._index.query_point(
+                      touch.x, touch.y) if child in shown]
+        candidates.sort(key=self.all_children.order, reverse=True)
+        for child in candidates:
+            if child.dispatch(name, touch):
+                return True
+        return False
+
     def on_touch_down_touch(self, touch):
         x, y = touch.x, touch.y
 
@@ -78,7 +178,7 @@ class MainPlane(ScatterPlane):
             # let the child widgets handle the event if they want
             touch.push()
             touch.apply_transform_2d(self.to_local)
-            if super(Scatter, self).on_touch_down(touch):
+            if self.dispatch_children('on_touch_down', touch):
                 touch.pop()
                 return True
             touch.pop()
@@ -101,7 +201,7 @@ class MainPlane(ScatterPlane):
             if not touch.grab_current == self:
                 touch.push()
                 touch.apply_transform_2d(self.to_local)
-                if super(Scatter, self).on_touch_move(touch):
+                if self.dispatch_children('on_touch_move', touch):
                     touch.pop()
                     return True
                 touch.pop()
@@ -125,7 +225,7 @@ class MainPlane(ScatterPlane):
             if not touch.grab_current == self:
                 touch.push()
                 touch.apply_transform_2d(self.to_local)
-                if super(Scatter, self).on_touch_up(touch):
+                if self.dispatch_children('on_touch_up', touch):
                     touch.pop()
                     return True
                 touch.pop()
@@ -140,61 +240,141 @@ class MainPlane(ScatterPlane):
 
     def on_touch_down_pen(self, pen):
         if pen.is_double_tap:
-            self.canvas.remove_group('lines')
+            bbox = self.strokes.get_bbox()
+            self.strokes.clear()
+            if bbox is not None:
+                self.ctrl.region_changed(bbox)
+            self.ctrl.set_dirty()
             return True
         pen.push()
         pen.apply_transform_2d(self.to_local)
-        with self.canvas:
-            Color(1, 1, 1, group='lines')
-            pen.ud.line = Line(points=list(pen.pos), group='lines')
+        pen.ud.stroke = self.strokes.begin(pen.x, pen.y,
+            self.stroke_tolerance / self.scale)
         pen.pop()
         return True
 
     def on_touch_move_pen(self, pen):
-        if 'line' not in pen.ud:
+        if 'stroke' not in pen.ud:
             return True
-        line = pen.ud.line
         pen.push()
         pen.apply_transform_2d(self.to_local)
-        line.points = line.points + list(pen.pos)
+        pen.ud.stroke.add_point(pen.x, pen.y)
         pen.pop()
         return True
 
     def on_touch_up_pen(self, pen):
+        if 'stroke' in pen.ud:
+            points = self.strokes.end(pen.ud.stroke)
+            del pen.ud['stroke']
+            if points:
+                self.ctrl.region_changed(points_bbox(points))
+            self.ctrl.set_dirty()
         return True
 
     #
     # Culling below
     #
 
-    def is_visible(self, w):
+    def get_viewport_quad(self, margin=0):
         '''
-        Determine if planeobject w (a scatter itself) is visible in the current
-        scatterplane viewport. Uses bounding circle check.
+        Return the 4 corners of the window (grown by margin pixels) in plane
+        coordinates, or None if the plane is not on a window.
         '''
-        # Get minimal bounding circle around widget
-        w_win_center = w.to_window(*w.pos)
-        lwc = self.to_local(*w_win_center)
-        # XXX Why does this not work instead of the previous two?
-        #lwc = w.to_parent(*w.center)
-        corner = w.to_parent(-w.width / 2., -w.height / 2.)
-        r = Vector(*lwc).distance(Vector(*corner))
-
-        # Get minimal bounding circle around viewport
-        # TODO If an optimization is required
         win = self.get_parent_window()
         if not win:
-            return False
-        cp = self.to_local(*win.center)
-        #ww, wh = Window.size
-        #topright = self.to_local(ww, wh)
-        botleft = self.to_local(0, 0)
-        wr = Vector(*cp).distance(botleft)
-
-        dist = Vector(*cp).distance(Vector(lwc))
-        if dist - r <= wr:
-            return True
-        return False
+            return None
+        w, h = win.size
+        m = margin
+        to_local = self.to_local
+        return (to_local(-m, -m), to_local(w + m, -m),
+                to_local(w + m, h + m), to_local(-m, h + m))
+
+    def get_viewport_quad_at(self, pos, rotation, scale, margin=0):
+        '''
+        Same as get_viewport_quad(), for the viewport the plane would have
+        with the given pos, rotation and scale, like a slide.
+
+        The viewport is computed without changing the plane, once
+        compute_viewport_quad() is checked against the current viewport.
+        Otherwise, the transformation is applied on the plane and restored.
+        '''
+        win = self.get_parent_window()
+        if not win:
+            return None
+        if self._viewport_computed is None:
+            computed = self.compute_viewport_quad(
+                win.size, self.pos, self.rotation, self.scale, margin)
+            current = self.get_viewport_quad(margin)
+            self._viewport_computed = all(
+                abs(a - b) <= 1e-4 * max(1., abs(b))
+                for p, q in zip(computed, current) for a, b in zip(p, q))
+        if self._viewport_computed:
+            return self.compute_viewport_quad(win.size, pos, rotation, scale,
+                                              margin)
+        spos = tuple(self.pos)
+        srotation = self.rotation
+        sscale = self.scale
+        try:
+            self.scale = scale
+            self.rotation = rotation
+            self.pos = pos
+            return self.get_viewport_quad(margin)
+        finally:
+            self.scale = sscale
+            self.rotation = srotation
+            self.pos = spos
+
+    def compute_viewport_quad(self, size, pos, rotation, scale, margin=0):
+        '''
+        Return the 4 corners of a window of the given size, in the plane
+        coordinates for the given pos, rotation and scale. Like the Scatter
+        properties, the plane rectangle is rotated and scaled, then
+        translated so its bounding box starts at pos.
+        '''
+        angle = radians(rotation)
+        a = cos(angle) * scale
+        b = sin(angle) * scale
+        w, h = self.size
+        corners = ((0, 0), (w, 0), (w, h), (0, h))
+        tx = pos[0] - min(x * a - y * b for x, y in corners)
+        ty = pos[1] - min(x * b + y * a for x, y in corners)
+        s2 = scale * scale
+        w, h = size
+        m = margin
+        quad = []
+        for x, y in ((-m, -m), (w + m, -m), (w + m, h + m), (-m, h + m)):
+            x -= tx
+            y -= ty
+            quad.append(((x * a + y * b) / s2, (y * a - x * b) / s2))
+        return tuple(quad)
+
+    def get_viewport_bbox(self, margin=0):
+        '''
+        Return the axis aligned bounding box of the window (grown by margin
+        pixels) in plane coordinates, or None if the plane is not on a window.
+        '''
+        quad = self.get_viewport_quad(margin)
+        if quad is None:
+            return None
+        return polygon_bbox(quad)
+
+    def _on_child_bbox(self, child, *largs):
+        self._index.update(child, child.bbox)
+        if self._circles is not None:
+            self._circles.update(child, *child.bounding_circle)
+
+    def is_visible(self, w, viewport=None, margin=0):
+        '''
+        Determine if planeobject w (a scatter itself) is visible in the current
+        scatterplane viewport, by testing its oriented bounding box against the
+        viewport. The viewport quad can be passed to avoid computing it for
+        every object, otherwise the viewport is grown by margin pixels.
+        '''
+        if viewport is None:
+            viewport = self.get_viewport_quad(margin)
+            if viewport is None:
+                return False
+        return obb_intersect(w.obb, viewport)
 
     def transform_with_touch(self, touch):
         self._trigger_cull()
@@ -208,48 +388,187 @@ class MainPlane(ScatterPlane):
         # Reserved for further use; e.g. stop video playback or whatever
         pass
 
+    def get_visible_children(self):
+        '''
+        Return the set of children to show for the current viewport. Children
+        already shown are kept until they are cull_margin pixels away from the
+        viewport, to avoid flapping on the border.
+        '''
+        margin = self.cull_margin
+        inner = self.get_viewport_quad()
+        if inner is None:
+            return set()
+        outer = self.get_viewport_quad(margin)
+        shown = self._visible
+        if self._circles is not None and \
+           len(self.all_children) >= self.cull_batch_threshold:
+            # test all the bounding circles at once
+            (x1, y1), _, (x2, y2), _ = inner
+            wr = hypot(x2 - x1, y2 - y1) / 2.
+            m = margin / self.scale
+            candidates = [child for child, dist in self._circles.query(
+                          (x1 + x2) / 2., (y1 + y2) / 2., wr + m)
+                          if dist <= -m or child in shown]
+        else:
+            candidates = self._index.query(polygon_bbox(outer))
+        return set(child for child in candidates
+                   if obb_intersect(child.obb,
+                                    outer if child in shown else inner))
+
+    def query_children(self, bbox):
+        '''
+        Return the list of children whose bounding box overlap bbox, in plane
+        coordinates.
+        '''
+        return self._index.query(bbox)
+
+    def get_children_in_quad(self, quad):
+        '''
+        Return the list of children whose oriented bounding box intersects
+        the quad, like a viewport, in plane coordinates.
+        '''
+        return [child for child in self._index.query(polygon_bbox(quad))
+                if obb_intersect(child.obb, quad)]
+
+    def get_transition_children(self, pos, rotation, scale):
+        '''
+        Return the set of children visible anywhere on the way from the
+        current viewport to the viewport of the given plane transformation,
+        as done by an Animation of the plane pos, rotation and scale.
+
+        The path is sampled in transition_steps, and the area swept between
+        two samples is approximated by the convex hull of their viewports.
+        The viewports are computed with get_viewport_quad_at(), the plane is
+        not moved.
+        '''
+        margin = self.cull_margin
+        steps = max(1, int(self.transition_steps))
+        spos = tuple(self.pos)
+        srotation = self.rotation
+        sscale = self.scale
+        quads = []
+        for step in xrange(steps + 1):
+            t = step / float(steps)
+            quad = self.get_viewport_quad_at(
+                (spos[0] + (pos[0] - spos[0]) * t,
+                 spos[1] + (pos[1] - spos[1]) * t),
+                srotation + (rotation - srotation) * t,
+                sscale + (scale - sscale) * t, margin)
+            if quad is None:
+                return set()
+            quads.append(quad)
+
+        children = set()
+        query = self._index.query
+        for index in xrange(len(quads) - 1):
+            hull = convex_hull(quads[index] + quads[index + 1])
+            children.update(child for child in query(polygon_bbox(hull))
+                            if child not in children and
+                            convex_intersect(child.obb, hull))
+        return children
+
     def cull_children(self, *args, **kwargs):
+        '''
+        Show the children visible in the current viewport, or the children
+        given in the `visible` keyword argument.
+        '''
         no_event = kwargs.get('no_event', False)
         # *args cause we use cull_children as a callback for animation's
         # on_progress
-        old_children = self.children[:]
-        self._really_clear_widgets()
+        visible = kwargs.get('visible')
+        if visible is None:
+            visible = self.get_visible_children()
+        shown = self._visible
+        leaving = [child for child in shown if child not in visible]
+        entering = [child for child in visible if child not in shown]
+
+        # only apply the difference on the canvas
+        for child in leaving:
+            self._really_remove_widget(child)
+        entering.sort(key=self.all_children.order)
+        for child in entering:
+            self._really_add_widget(child)
 
-        for child in reversed(self.all_children):
-            if self.is_visible(child):
-                self._really_add_widget(child)
-                if not no_event and not child in old_children:
-                    self.dispatch('on_scene_enter', child)
         if no_event:
             return
-        for child in old_children:
-            if child not in self.children:
-                self.dispatch('on_scene_leave', child)
+        for child in entering:
+            self.dispatch('on_scene_enter', child)
+        for child in leaving:
+            self.dispatch('on_scene_leave', child)
 
     def add_widget(self, child):
         assert isinstance(child, PlaneObject)
 
-        self.all_children.insert(0, child)
-        self._really_add_widget(child, front=True)
+        self.all_children.add(child)
+        self._on_child_bbox(child)
+        child.bind(transform=self._on_child_bbox, size=self._on_child_bbox)
+        # don't show objects loaded out of the viewport
+        if self.is_visible(child):
+            self._really_add_widget(child)
         self._trigger_cull()
 
+    def raise_widget(self, child):
+        '''Move a child in front of the others.
+        '''
+        shown = child in self._visible
+        if shown:
+            self._really_remove_widget(child)
+        self.all_children.raise_to_front(child)
+        if shown:
+            self._really_add_widget(child)
+        if self.ctrl:
+            self.ctrl.order_changed(child)
+
+    def lower_widget(self, child):
+        '''Move a child behind the others.
+        '''
+        shown = child in self._visible
+        if shown:
+            self._really_remove_widget(child)
+        self.all_children.lower_to_back(child)
+        if shown:
+            self._really_add_widget(child)
+        if self.ctrl:
+            self.ctrl.order_changed(child)
+
     def remove_widget(self, child):
+        if child in self._visible:
+            self._really_remove_widget(child)
         self.all_children.remove(child)
-        self._really_remove_widget(child)
+        self._index.remove(child)
+        if self._circles is not None:
+            self._circles.remove(child)
+        child.unbind(transform=self._on_child_bbox, size=self._on_child_bbox)
         self._trigger_cull()
 
     def clear_widgets(self):
-        self.all_children = []
         self._really_clear_widgets()
-
-    def _really_add_widget(self, child, front=False):
+        for child in self.all_children:
+            child.unbind(transform=self._on_child_bbox,
+                         size=self._on_child_bbox)
+        self.all_children.clear()
+        self._index.clear()
+        if self._circles is not None:
+            self._circles.clear()
+
+    def _really_add_widget(self, child):
+        # keep the canvas sorted by z-order: self._orders is the sorted list
+        # of the shown children orders, in drawing order
         child.parent = self
-        self.children.insert(0, child)
-        self.canvas.add(child.canvas)
+        orders = self._orders
+        order = self.all_children.order(child)
+        index = bisect(orders, order)
+        orders.insert(index, order)
+        self._visible.add(child)
+        self.children.insert(len(self.children) - index, child)
+        self.canvas_objects.insert(index, child.canvas)
 
     def _really_remove_widget(self, child):
+        orders = self._orders
+        del orders[bisect_left(orders, self.all_children.order(child))]
+        self._visible.discard(child)
         self.children.remove(child)
-        self.canvas.remove(child.canvas)
+        self.canvas_objects.remove(child.canvas)
 
     def _really_clear_widgets(self):
         for child in self.children[:]:
@@ -1,88 +1,234 @@
+'''
+Slides of the presentation
+
+The slides are kept in a Deck, independent of the widgets: a slide is a
+DeckSlide, and the sidebar only creates Slide widgets for the rows it
+shows, recycled while scrolling. Thumbnails are in the atlas of the
+controler, and uploaded there when their slide is shown.
+'''
+
+from math import ceil
+from kivy.clock import Clock
 from kivy.factory import Factory
-from kivy.properties import ObjectProperty, NumericProperty, \
-        ListProperty, BooleanProperty
-from kivy.graphics import Fbo, Rectangle, Color
-from kivy.graphics.opengl import glReadPixels, GL_RGBA, GL_UNSIGNED_BYTE
+from kivy.uix.widget import Widget
+from kivy.properties import ObjectProperty, NumericProperty, BooleanProperty
+from document import strip_alpha
 
 
-class Slide(Factory.ButtonBehavior, Factory.Image):
+class DeckSlide(object):
+    '''Slide of the deck: its place on the plane and its thumbnail.
 
-    ctrl = ObjectProperty(None)
+    `thumb` is the thumbnail on the cpu, as raw (w, h, pixels) or as a
+    Thumbnail, None if not read back yet. `texture` is its region in the
+    atlas, None if not uploaded. `view` is the Slide widget showing it in
+    the sidebar, if any.
+    '''
 
-    slide_rotation = NumericProperty(0)
+    __slots__ = ('pos', 'rotation', 'scale', 'thumb', 'texture', 'index',
+                 'view')
 
-    slide_scale = NumericProperty(1.)
+    def __init__(self, pos, rotation, scale, thumb=None):
+        self.pos = tuple(pos)
+        self.rotation = rotation
+        self.scale = scale
+        self.thumb = thumb
+        self.texture = None
+        self.index = 0
+        self.view = None
 
-    slide_pos = ListProperty([0,0])
+    def set_texture(self, texture):
+        self.texture = texture
+        if self.view is not None:
+            self.view.set_texture(texture)
+
+    def capture(self, atlas, texture):
+        '''Draw the capture texture in our cell of the atlas.
+        '''
+        self.set_texture(atlas.render(self, texture))
+        self.thumb = None
+
+    def download_thumb(self, atlas):
+        '''Read the capture back from the atlas, as raw RGB pixels in
+        `thumb`.
+        '''
+        if self.thumb is None:
+            data = atlas.read(self)
+            if data is not None:
+                w, h, pixels = data
+                self.thumb = (w, h, strip_alpha(pixels))
+
+    def upload_thumb(self, atlas):
+        w, h, pixels = self.thumb
+        self.set_texture(atlas.upload(self, w, h, pixels))
+        # the pixels are on the gpu now, an encoded thumbnail can drop them
+        if hasattr(self.thumb, 'release'):
+            self.thumb.release()
+
+    def thumb_evicted(self, atlas):
+        # our cell of the atlas is given to another slide, keep the pixels
+        # to show the thumbnail again later, see restore_thumb()
+        self.download_thumb(atlas)
+        self.set_texture(None)
+
+    def restore_thumb(self, atlas):
+        '''Upload the thumbnail in the atlas if it's not there.
+        '''
+        if self.texture is not None:
+            atlas.use(self)
+        elif self.thumb is not None:
+            self.upload_thumb(atlas)
+
+
+class Deck(object):
+    '''Ordered list of DeckSlide, and the selected one. Getting a slide by
+    index and its index are O(1), removing a slide numbers again the next
+    ones.
+    '''
+
+    def __init__(self):
+        self.slides = []
+        self.selected = None
+
+    def __len__(self):
+        return len(self.slides)
+
+    def __iter__(self):
+        return iter(self.slides)
+
+    def __getitem__(self, index):
+        return self.slides[index]
+
+    def add(self, slide):
+        slide.index = len(self.slides)
+        self.slides.append(slide)
+        return slide
+
+    def remove(self, slide):
+        slides = self.slides
+        del slides[slide.index]
+        for index in xrange(slide.index, len(slides)):
+            slides[index].index = index
+        if self.selected is slide:
+            self.selected = None
+
+    def get(self, index):
+        '''Return the slide at index, wrapping around the deck.
+        '''
+        return self.slides[index % len(self.slides)]
+
+    def current(self):
+        '''Return the selected slide, or the last one.
+        '''
+        if self.selected is not None:
+            return self.selected
+        if self.slides:
+            return self.slides[-1]
+
+
+class Slide(Factory.ButtonBehavior, Factory.Image):
+    '''Row of the sidebar, showing the DeckSlide `slide`.
+    '''
+
+    ctrl = ObjectProperty(None)
+
+    slide = ObjectProperty(None, allownone=True)
 
     selected = BooleanProperty(False)
 
     index = NumericProperty(0)
 
-    def __init__(self, **kwargs):
-        # get raw rgb thumb is available
-        self.thumb = kwargs.get('thumb', None)
-        del kwargs['thumb']
-        # extract controler now, we need it.
-        self.ctrl = kwargs.get('ctrl')
-        # create fbo for tiny texture
-        self.fbo = Fbo(size=(160, 120))
-        with self.fbo:
-            Color(1, 1, 1)
-            Rectangle(size=self.fbo.size)
-            self.fborect = Rectangle(size=self.fbo.size)
-        if self.thumb:
-            self.upload_thumb()
-        else:
-            self.update_capture()
-        super(Slide, self).__init__(**kwargs)
-
     def on_press(self, touch):
         if touch.is_double_tap:
-            self.ctrl.remove_slide(self)
+            self.ctrl.remove_slide(self.slide)
         else:
-            self.ctrl.select_slide(self)
-
-    def update_capture(self, *largs):
-        edit_mode = self.ctrl.is_edit
-        self.ctrl.is_edit = False
-
-        # update main fbo
-        fbo = self.ctrl.capture.fbo
-        fbo.ask_update()
-        fbo.draw()
+            self.ctrl.select_slide(self.slide)
+
+    def show(self, slide):
+        '''Show another slide, or nothing if slide is None.
+        '''
+        if self.slide is not None and self.slide.view is self:
+            self.slide.view = None
+        self.slide = slide
+        if slide is None:
+            self.set_texture(None)
+            return
+        slide.view = self
+        self.index = slide.index
+        self.selected = slide is self.ctrl.deck.selected
+        slide.restore_thumb(self.ctrl.atlas)
+        self.set_texture(slide.texture)
+
+    def set_texture(self, texture):
+        self.texture = texture
+        self.texture_size = texture.size if texture is not None else (0, 0)
 
-        # update our tiny fbo
-        self.fborect.texture = fbo.texture
-        self.fbo.ask_update()
-        self.fbo.draw()
 
-        # then bind the texture to our texture image
-        self.texture = self.fbo.texture
-        self.texture_size = self.texture.size
+class SlideList(Widget):
+    '''Sidebar of the slides, in a ScrollView. The list is as high as all
+    the rows, but only the visible rows have a Slide widget. Widgets of
+    the rows scrolled away are reused for the rows scrolled in.
+    '''
 
-        self.ctrl.is_edit = edit_mode
-        self.ctrl.set_dirty()
-        self.thumb = None
+    ctrl = ObjectProperty(None)
 
-    def download_thumb(self):
-        if self.thumb is None:
-            fbo = self.fbo
-            fbo.draw()
-            fbo.bind()
-            tmp = glReadPixels(0, 0, fbo.size[0], fbo.size[1], GL_RGBA, GL_UNSIGNED_BYTE)
-            fbo.release()
-            # remove alpha
-            tmp = list(tmp)
-            del tmp[3::4]
-            tmp = ''.join(tmp)
-            self.thumb = (fbo.size[0], fbo.size[1], tmp)
-
-    def upload_thumb(self):
-        from kivy.graphics.texture import Texture
-        w, h, pixels = self.thumb
-        texture = Texture.create((w, h), 'rgb', 'ubyte')
-        texture.blit_buffer(pixels, colorfmt='rgb')
-        self.texture = texture
-        self.texture_size = texture.size
+    row_height = NumericProperty(54)
 
+    def __init__(self, **kwargs):
+        self._views = {}
+        self._pool = []
+        self.trigger_refresh = Clock.create_trigger(self.refresh, -1)
+        super(SlideList, self).__init__(**kwargs)
+        self.bind(pos=self.trigger_refresh, size=self.trigger_refresh)
+
+    def get_visible_range(self):
+        '''Return the (first, last + 1) indexes of the visible rows.
+        '''
+        view = self.parent
+        count = len(self.ctrl.deck)
+        if view is None or view.parent is None:
+            return 0, count
+        # the rows are from top to bottom, compare them in window coordinates
+        vy = view.parent.to_window(*view.pos)[1]
+        top = self.to_window(self.x, self.top)[1]
+        h = float(self.row_height)
+        first = int((top - vy - view.height) // h)
+        last = int(ceil((top - vy) / h))
+        return max(0, first), min(count, last)
+
+    def refresh(self, *largs):
+        '''Show the visible rows, after a scroll or a change of the deck.
+        '''
+        if self.ctrl is None:
+            return
+        deck = self.ctrl.deck
+        height = len(deck) * self.row_height
+        if self.height != height:
+            # the new size will refresh again
+            self.height = height
+            return
+        first, last = self.get_visible_range()
+        views = self._views
+        for index in views.keys():
+            if not first <= index < last:
+                view = views.pop(index)
+                view.show(None)
+                self.remove_widget(view)
+                self._pool.append(view)
+        h = self.row_height
+        for index in xrange(first, last):
+            view = views.get(index)
+            if view is None:
+                if self._pool:
+                    view = self._pool.pop()
+                else:
+                    view = Slide(ctrl=self.ctrl)
+                views[index] = view
+                self.add_widget(view)
+            slide = deck[index]
+            if view.slide is not slide:
+                view.show(slide)
+            view.index = index
+            view.pos = self.x, self.top - (index + 1) * h
+            view.size = self.width, h
+
+Factory.register('SlideList', cls=SlideList)
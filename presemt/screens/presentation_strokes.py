@@ -0,0 +1,197 @@
+'''
+Pen strokes drawn on the plane
+
+While a stroke is drawn, only its last chunk of points is uploaded on every
+move, so the cost of a move doesn't depend on the stroke length. Finished
+strokes are simplified and merged into a few shared meshes.
+'''
+
+from kivy.graphics import Canvas, Color, Line
+from document import new_uid
+from quadtree import bbox_union
+try:
+    from kivy.graphics import Mesh
+except ImportError:
+    # one Line per finished stroke on older kivy
+    Mesh = None
+
+
+def simplify(points, tolerance):
+    '''Simplify a flat list of points [x0, y0, x1, y1, ...] with the
+    Douglas-Peucker algorithm, and return the flat list of kept points.
+    '''
+    count = len(points) // 2
+    if count < 3:
+        return list(points)
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    tolerance2 = tolerance * tolerance
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = points[first * 2], points[first * 2 + 1]
+        x2, y2 = points[last * 2], points[last * 2 + 1]
+        dx = x2 - x1
+        dy = y2 - y1
+        length2 = dx * dx + dy * dy
+        index = -1
+        dmax = tolerance2
+        for i in xrange(first + 1, last):
+            px = points[i * 2] - x1
+            py = points[i * 2 + 1] - y1
+            if length2:
+                # squared distance to the segment line
+                cross = px * dy - py * dx
+                d = cross * cross / length2
+            else:
+                d = px * px + py * py
+            if d > dmax:
+                index = i
+                dmax = d
+        if index != -1:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    result = []
+    for i in xrange(count):
+        if keep[i]:
+            result.extend((points[i * 2], points[i * 2 + 1]))
+    return result
+
+
+def points_bbox(points):
+    '''Return the bounding box (x1, y1, x2, y2) of a flat list of points.
+    '''
+    xs = points[::2]
+    ys = points[1::2]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+class Stroke(object):
+    '''Stroke being drawn. Points closer than `tolerance` to the last kept
+    point are dropped as they come. Points are drawn by chunks of `chunk`
+    points, only the last chunk is updated.
+    '''
+
+    def __init__(self, canvas, x, y, tolerance, color, chunk=64):
+        self.points = [x, y]
+        self.color = color
+        self.tolerance = tolerance
+        self.chunk = chunk
+        self.canvas = canvas
+        with canvas:
+            Color(*color)
+        self._start_line(x, y)
+
+    def _start_line(self, x, y):
+        self._line_points = [x, y]
+        with self.canvas:
+            self._line = Line(points=self._line_points)
+
+    def add_point(self, x, y):
+        points = self.points
+        dx = x - points[-2]
+        dy = y - points[-1]
+        if dx * dx + dy * dy < self.tolerance * self.tolerance:
+            return
+        points.extend((x, y))
+        line_points = self._line_points
+        line_points.extend((x, y))
+        self._line.points = line_points
+        if len(line_points) >= self.chunk * 2:
+            # freeze this chunk, and continue in a new one
+            self._start_line(x, y)
+
+
+class StrokeLayer(object):
+    '''Hold the finished strokes of the plane, batched per color into meshes
+    of at most `batch_size` vertices, and the strokes being drawn.
+    Finished strokes are kept in `strokes` as (points, color, uid).
+    '''
+
+    def __init__(self, batch_size=4096):
+        self.batch_size = batch_size
+        self.canvas = Canvas()
+        self.strokes = []
+        self._finished = Canvas()
+        self._live = Canvas()
+        self.canvas.add(self._finished)
+        self.canvas.add(self._live)
+        self._batches = {}
+
+    def begin(self, x, y, tolerance, color=(1, 1, 1, 1)):
+        '''Start a new stroke at x, y, and return it.
+        '''
+        group = Canvas()
+        self._live.add(group)
+        return Stroke(group, x, y, tolerance, tuple(color))
+
+    def end(self, stroke):
+        '''Finish a stroke: simplify it and move it to the shared meshes.
+        '''
+        self._live.remove(stroke.canvas)
+        points = simplify(stroke.points, stroke.tolerance)
+        self.add(points, stroke.color)
+        return points
+
+    def add(self, points, color=(1, 1, 1, 1), uid=None):
+        '''Add a finished stroke, as a flat list of points.
+        '''
+        color = tuple(color)
+        if not points:
+            return
+        self.strokes.append((points, color, uid or new_uid()))
+        if Mesh is None:
+            with self._finished:
+                Color(*color)
+                Line(points=points)
+            return
+        # split long strokes on batch boundaries, the pieces share a point
+        size = self.batch_size
+        count = len(points) // 2
+        start = 0
+        while True:
+            end = min(count, start + size)
+            self._batch(points[start * 2:end * 2], color)
+            if end == count:
+                break
+            start = end - 1
+
+    def _batch(self, points, color):
+        count = len(points) // 2
+        batches = self._batches.setdefault(color, [])
+        if not batches or len(batches[-1][0]) // 4 + count > self.batch_size:
+            with self._finished:
+                Color(*color)
+                mesh = Mesh(vertices=[], indices=[], mode='lines')
+            batches.append(([], [], mesh))
+        vertices, indices, mesh = batches[-1]
+        base = len(vertices) // 4
+        for i in xrange(count):
+            vertices.extend((points[i * 2], points[i * 2 + 1], 0, 0))
+        if count == 1:
+            indices.extend((base, base))
+        for i in xrange(base, base + count - 1):
+            indices.extend((i, i + 1))
+        mesh.vertices = vertices
+        mesh.indices = indices
+
+    def get_bbox(self):
+        '''Return the bounding box of the finished strokes, or None if there
+        is none.
+        '''
+        bbox = None
+        for points, color, uid in self.strokes:
+            if bbox is None:
+                bbox = points_bbox(points)
+            else:
+                bbox = bbox_union(bbox, points_bbox(points))
+        return bbox
+
+    def clear(self):
+        '''Remove all the strokes.
+        '''
+        self.strokes = []
+        self._batches = {}
+        self._finished.clear()
+        self._live.clear()
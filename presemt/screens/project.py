@@ -1,12 +1,11 @@
 from . import Screen
-from os import listdir
-from os.path import join, exists
 from datetime import datetime
 
-from document import Document
+from workspace import WorkspaceIndex
 from kivy.lang import Builder
 from kivy.graphics.texture import Texture
 from kivy.properties import ObjectProperty, NumericProperty, StringProperty
+from kivy.clock import Clock
 from kivy.animation import Animation
 from kivy.uix.floatlayout import FloatLayout
 
@@ -26,6 +25,10 @@ class ModalConfirm(Modal):
 class ModalHelp(Modal):
     pass
 
+class ModalRecover(Modal):
+    recovery = ObjectProperty(None)
+    title = StringProperty('')
+
 class SelectorScreen(Screen):
 
     modalselect = ObjectProperty(None, allownone=True)
@@ -34,7 +37,10 @@ class SelectorScreen(Screen):
 
     modalhelp = ObjectProperty(None, allownone=True)
 
+    modalrecover = ObjectProperty(None, allownone=True)
+
     def __init__(self, **kwargs):
+        self._index = None
         super(SelectorScreen, self).__init__(**kwargs)
 
     def on_parent(self, instance, value):
@@ -70,6 +76,33 @@ class SelectorScreen(Screen):
         self.modalhelp = None
 
 
+    def ask_recover(self, recovery):
+        if self.modalrecover:
+            self.leave_recover()
+        meta = recovery.load_meta()
+        dt = datetime.fromtimestamp(meta['time'])
+        self.modalrecover = modalrecover = ModalRecover(
+            app=self, recovery=recovery,
+            title='Unsaved changes from %s' % dt.strftime('%d/%m/%y %H:%M'))
+        self.add_widget(modalrecover)
+        Animation(alpha=1, d=.5, t='out_cubic').start(modalrecover)
+
+    def leave_recover(self):
+        if not self.modalrecover:
+            return
+        self.remove_widget(self.modalrecover)
+        self.modalrecover = None
+
+    def do_recover(self, recovery):
+        self.leave_recover()
+        self.app.recover_project(recovery)
+
+    def discard_recovery(self, recovery):
+        self.leave_recover()
+        recovery.remove()
+        # next one, if several sessions were lost
+        Clock.schedule_once(lambda dt: self.app.offer_recovery())
+
     def delete_project(self, filename, force=False):
         if force:
             self.app.delete_project(filename)
@@ -100,36 +133,26 @@ class SelectorScreen(Screen):
 
     def search_documents(self):
         ws = self.app.config.get('paths', 'workspace')
-        if not exists(ws):
-            return
-        docs = []
-        for item in listdir(ws):
-            fn = join(ws, item, 'project.json')
-            if not exists(fn):
-                continue
-            doc = Document()
-            doc.load(fn)
-            docs.append((doc, fn))
-
-        docs.sort(lambda a, b: cmp(a[0].infos.time_modification, b[0].infos.time_modification))
-        for doc, filename in docs:
-            self.load_document(doc, filename)
-
-    def load_document(self, doc, filename):
+        if self._index is None or self._index.workspace != ws:
+            self._index = WorkspaceIndex(ws)
+        for entry in self._index.update():
+            self.load_document(entry)
+
+    def load_document(self, entry):
         view = self.view
 
         def thumb_texture(thumb):
             w, h, pixels = thumb
             texture = Texture.create((w, h), 'rgb', 'ubyte')
             texture.blit_buffer(pixels, colorfmt='rgb')
+            thumb.release()
             return texture
 
-        slides = list(doc.slides)
         title = ''
-        texs = [thumb_texture(s.thumb) for s in slides[0:3]]
+        texs = [thumb_texture(t) for t in self._index.get_thumbnails(entry)]
         texs.extend([None, None, None])
         tex0, tex1, tex2 = texs[0:3]
-        dt = datetime.fromtimestamp(doc.infos.time_modification)
+        dt = datetime.fromtimestamp(entry['time_modification'])
 
         if tex0 is None:
             title = 'No preview available'
@@ -139,9 +162,9 @@ class SelectorScreen(Screen):
             title=title,
             time=dt.strftime('%d/%m/%y %H:%M'),
             tex0=tex0, tex1=tex1, tex2=tex2,
-            slide_count=len(slides),
-            obj_count=len(list(doc.objects)),
-            filename=filename)
+            slide_count=entry['slide_count'],
+            obj_count=entry['object_count'],
+            filename=entry['filename'])
         self.view.add_widget(item)
 
     def do_edit(self, filename):
@@ -0,0 +1,110 @@
+'''
+Workspace index
+===============
+
+Metadata of every project of the workspace, stored in `index.json` at the
+root of the workspace. An entry is keyed by the project filename, and is
+rebuilt only when the modification time or the size of the project changed,
+so listing the projects doesn't need to load them.
+'''
+
+__all__ = ('WorkspaceIndex', )
+
+import json
+from os import listdir, stat
+from os.path import join, exists
+from document import Document, Thumbnail, replace_file
+
+
+class WorkspaceIndex(object):
+    '''Index of the projects of a workspace.
+
+    Each entry is a dict with the keys `filename`, `mtime`, `size`,
+    `time_modification`, `slide_count`, `object_count` and `thumbs`, the
+    encoded thumbnails of the first `preview_count` slides.
+    '''
+
+    version = 1
+
+    preview_count = 3
+
+    def __init__(self, workspace):
+        self.workspace = workspace
+        self.filename = join(workspace, 'index.json')
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        self.entries = {}
+        if not exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'r') as fd:
+                j = json.loads(fd.read())
+        except (IOError, ValueError):
+            return
+        if j.get('version') != self.version:
+            return
+        self.entries = j['entries']
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as fd:
+            fd.write(json.dumps({'version': self.version,
+                                 'entries': self.entries}))
+        replace_file(tmp, self.filename)
+
+    def build_entry(self, filename, st):
+        doc = Document()
+        doc.load(filename)
+        thumbs = []
+        for slide in doc.slides:
+            if len(thumbs) == self.preview_count:
+                break
+            if slide.thumb is not None:
+                thumbs.append(slide.thumb.to_json())
+        return {
+            'filename': filename,
+            'mtime': st.st_mtime,
+            'size': st.st_size,
+            'time_modification': doc.infos.time_modification,
+            'slide_count': doc.slide_count,
+            'object_count': doc.object_count,
+            'thumbs': thumbs}
+
+    def update(self):
+        '''Scan the workspace, rebuild the entries of the changed projects,
+        and return the list of entries sorted by modification time.
+        '''
+        if not exists(self.workspace):
+            return []
+        entries = {}
+        changed = False
+        for item in listdir(self.workspace):
+            fn = join(self.workspace, item, 'project.json')
+            try:
+                st = stat(fn)
+            except OSError:
+                continue
+            entry = self.entries.get(fn)
+            if entry is None or entry['mtime'] != st.st_mtime or \
+               entry['size'] != st.st_size:
+                try:
+                    entry = self.build_entry(fn, st)
+                except (IOError, ValueError, KeyError):
+                    continue
+                changed = True
+            entries[fn] = entry
+        if changed or len(entries) != len(self.entries):
+            self.entries = entries
+            try:
+                self.save()
+            except (IOError, OSError):
+                pass
+        return sorted(entries.itervalues(),
+                      key=lambda entry: entry['time_modification'])
+
+    def get_thumbnails(self, entry):
+        '''Return the preview Thumbnail list of an entry.
+        '''
+        return [Thumbnail.from_json(thumb) for thumb in entry['thumbs']]
@@ -0,0 +1,53 @@
+'''
+Convert projects between json and the binary format
+====================================================
+
+The project is loaded, with its journal, and saved again in place in the
+requested format. Both formats are loaded by Document.load(), the file name
+doesn't change.
+
+Usage::
+
+    python tools/convert_document.py binary|json <project.json or workspace> ...
+'''
+
+import sys
+from os.path import join, dirname, isdir, exists, getsize
+from os import listdir
+
+sys.path.insert(0, join(dirname(__file__), '..', 'presemt'))
+from document import Document
+
+
+def find_projects(path):
+    if not isdir(path):
+        return [path]
+    projects = []
+    for item in sorted(listdir(path)):
+        fn = join(path, item, 'project.json')
+        if exists(fn):
+            projects.append(fn)
+    return projects
+
+
+def convert(filename, binary):
+    before = getsize(filename)
+    doc = Document()
+    doc.load(filename)
+    if doc.binary == binary:
+        print '%s: already converted' % filename
+        return
+    doc.save(filename, touch=False, binary=binary)
+    doc.cleanup()
+    print '%s: %d objects, %d -> %d bytes' % (
+        filename, doc.object_count, before, getsize(filename))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('binary', 'json'):
+        print __doc__
+        sys.exit(1)
+    binary = sys.argv[1] == 'binary'
+    for path in sys.argv[2:]:
+        for filename in find_projects(path):
+            convert(filename, binary)
@@ -0,0 +1,72 @@
+'''
+Migrate projects to thumbnail containers
+========================================
+
+Projects saved by older versions embed every slide thumbnail as a base64
+data uri in project.json. Loading and saving them again moves the
+thumbnails into a thumbnail container next to the json.
+
+Usage::
+
+    python tools/migrate_thumbs.py <project.json or workspace> ...
+'''
+
+import sys
+import json
+from os import listdir
+from os.path import join, dirname, isdir, exists, getsize
+
+sys.path.insert(0, join(dirname(__file__), '..', 'presemt'))
+from document import Document, ThumbnailContainer, JPEG_HEADER
+from document_binary import is_binary
+
+
+def find_projects(path):
+    if not isdir(path):
+        return [path]
+    projects = []
+    for item in sorted(listdir(path)):
+        fn = join(path, item, 'project.json')
+        if exists(fn):
+            projects.append(fn)
+    return projects
+
+
+def has_inline_thumbs(filename):
+    '''Return True if a slide of the project json still has its thumbnail
+    inlined as a data uri. Binary documents never have one.
+    '''
+    if is_binary(filename):
+        return False
+    with open(filename, 'rb') as fd:
+        slides = json.loads(fd.read())['slides']
+    return any(slide.get('thumb') and
+               slide['thumb'][2].startswith(JPEG_HEADER)
+               for slide in slides)
+
+
+def migrate(filename):
+    # a project edited since the containers has one, but its json can
+    # still have the inline thumbnails of the slides not captured again
+    if not has_inline_thumbs(filename):
+        print '%s: already migrated' % filename
+        return
+    before = getsize(filename)
+    doc = Document()
+    doc.load(filename)
+    doc.save(filename, touch=False)
+    doc.cleanup()
+    container = ThumbnailContainer.get_filename(filename,
+                                                doc.infos.generation)
+    print '%s: %d slides, %d -> %d bytes (+ %d bytes of thumbnails)' % (
+        filename, doc.slide_count, before, getsize(filename),
+        getsize(container))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    for path in sys.argv[1:]:
+        for filename in find_projects(path):
+            migrate(filename)